@@ -2,21 +2,63 @@
 PyMOL AI Agent — core conversation loop.
 
 Usage:
-    python agent.py              # start in guided mode
-    python agent.py --expert     # start in expert mode
+    python agent.py                 # start in guided mode
+    python agent.py --expert        # start in expert mode
+    python agent.py --state-delta   # send session-state diffs instead of full dumps
+    python agent.py --metrics-log metrics.jsonl   # log per-command timings
+    python agent.py --in-process    # run PyMOL in this process (no time budgets)
+    python agent.py --stream        # print replies and run commands as they stream in
+    python agent.py --backend stub  # offline: canned replies from a local stub client
+    python agent.py --backend openai:http://127.0.0.1:8765/v1   # OpenAI-compatible server
+    python agent.py --max-steps 1   # never send command results back automatically
+    python agent.py --response-cache .reply_cache   # replay replies to repeated requests
+    python agent.py --no-fast-path  # send plain PyMOL commands to the model as well
+    python agent.py --batch jobs.jsonl --concurrency 8   # headless: run a file of requests
+    python agent.py --structure-mirror /data/pdb   # offline: PDB IDs only from a local mirror
 
 Runtime commands (type at the prompt):
     expert / guided   switch mode mid-session
+    state             send the full session state with the next message
+    metrics           print per-command timing statistics
+    usage             print per-turn token usage and prompt-cache hits
     quit / exit       end session
 """
 
+import json
+import os
 import re
 import sys
+import time
+import queue
+import threading
 import argparse
+import contextvars
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import anthropic
+from llm_backend import BACKENDS, BackendError, LLMBackend, make_backend
+from response_cache import ResponseCache, session_fingerprint
+from structure_cache import prefetch_refs
 
-from pymol_interface import get_session_state, execute_command, close_session
+from intent_router import route as route_intent
+
+from pymol_interface import (
+    DIRECT_COMMANDS,
+    close_session,
+    execute_batch,
+    format_session_state,
+    format_session_state_delta,
+    get_command_metrics,
+    close_worker_pool,
+    get_session_snapshot,
+    is_direct_command,
+    load_structure,
+    reset_session,
+    set_metrics_log,
+    start_supervised_session,
+    start_worker_pool,
+    use_session,
+)
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -28,6 +70,29 @@ load_dotenv()
 MODEL = "claude-haiku-4-5-20251001"
 MAX_TOKENS = 2048
 SYSTEM_PROMPT_FILE = "system_prompt.txt"
+STATE_FULL_EVERY = 10   # with --state-delta, resend the full state every K turns
+STATE_COLLECTOR = "iterate"   # single-pass collector with residue/ligand detail
+STATE_MAX_CHARS = 8000        # budget for the full session-state block
+STOP_ON_ERROR = False         # keep running a reply's commands after a failure
+HISTORY_MAX_CHARS = 80_000    # conversation budget (~20k tokens) before old turns are dropped
+HISTORY_COMPACT_TO = 50_000   # a compaction pass shrinks the history to this, leaving room for the next turns
+HISTORY_KEEP_TURNS = 6        # most recent turns that are never compacted
+OLD_OUTPUT_MAX_CHARS = 400    # command outputs kept from turns older than that
+MAX_AGENT_STEPS = 5           # model calls per user message (1 = no automatic follow-ups)
+AGENT_TIME_BUDGET_S = 120     # no new follow-up step is started after this many seconds
+RESPONSE_CACHE_MAX_MB = 64    # --response-cache size limit
+RESPONSE_CACHE_TTL_H = 168    # --response-cache default expiry (one week)
+FAST_PATH = True              # run plain PyMOL commands and simple phrasings without the model
+PREFETCH = True               # download structures named in messages and commands ahead of use
+BATCH_CONCURRENCY = 4         # --batch: jobs run at once, one PyMOL worker each
+
+FOLLOW_UP_MESSAGE = (
+    "(Automatic follow-up: the commands from your last reply have run. "
+    "Continue the task using their outputs, or reply without <pymol> commands if it is done.)"
+)
+
+# Appended in the history to a streamed reply that the API cut off
+STREAM_INTERRUPTED_NOTE = "\n[reply interrupted by an API error]"
 
 # ---------------------------------------------------------------------------
 # Command parsing
@@ -41,20 +106,585 @@ def extract_commands(text: str) -> list[str]:
     return [m.strip() for m in _CMD_RE.findall(text) if m.strip()]
 
 
+class StreamingCommandParser:
+    """
+    Incremental counterpart of extract_commands for streamed replies.
+
+    feed() takes text deltas and returns the prose that is safe to print
+    plus every command whose closing </pymol> tag has arrived. A possible
+    partial opening tag at the end of a delta is held back until the next
+    one decides it.
+    """
+
+    OPEN, CLOSE = "<pymol>", "</pymol>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_command = False
+
+    def feed(self, delta: str) -> tuple[str, list[str]]:
+        self._buffer += delta
+        prose, commands = [], []
+        while True:
+            if self._in_command:
+                end = self._buffer.find(self.CLOSE)
+                if end < 0:
+                    break
+                command = self._buffer[:end].strip()
+                if command:
+                    commands.append(command)
+                self._buffer = self._buffer[end + len(self.CLOSE):]
+                self._in_command = False
+            else:
+                start = self._buffer.find(self.OPEN)
+                if start < 0:
+                    keep = self._partial_tag_length()
+                    prose.append(self._buffer[:len(self._buffer) - keep])
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                prose.append(self._buffer[:start])
+                self._buffer = self._buffer[start + len(self.OPEN):]
+                self._in_command = True
+        return "".join(prose), commands
+
+    def flush(self) -> str:
+        """Return whatever prose is still held back (call once the stream ends)."""
+        text = "" if self._in_command else self._buffer
+        self._buffer = ""
+        return text
+
+    def _partial_tag_length(self) -> int:
+        for n in range(min(len(self.OPEN) - 1, len(self._buffer)), 0, -1):
+            if self.OPEN.startswith(self._buffer[-n:]):
+                return n
+        return 0
+
+
+# ---------------------------------------------------------------------------
+# Token usage
+# ---------------------------------------------------------------------------
+
+def format_usage(usage_log: list[dict]) -> str:
+    """Per-turn token usage table with totals and the overall cache hit rate."""
+    if not usage_log:
+        return "No LLM calls yet.\n"
+    lines = [f"{'turn':>4}{'input':>9}{'cache rd':>10}{'cache wr':>10}{'output':>8}"]
+    for turn, u in enumerate(usage_log, 1):
+        lines.append(f"{turn:>4}{u['input']:>9}{u['cache_read']:>10}{u['cache_write']:>10}{u['output']:>8}")
+    totals = {key: sum(u[key] for u in usage_log) for key in usage_log[0]}
+    prompt = totals["input"] + totals["cache_read"] + totals["cache_write"]
+    hit_rate = totals["cache_read"] / prompt if prompt else 0.0
+    lines.append(
+        f"{'all':>4}{totals['input']:>9}{totals['cache_read']:>10}{totals['cache_write']:>10}"
+        f"{totals['output']:>8}   cache hit rate {hit_rate:.0%}"
+    )
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------------------------------
+# Conversation history
+# ---------------------------------------------------------------------------
+
+# Headers of the context blocks appended to each user message
+FULL_STATE_HEADER = "\n\nCurrent PyMOL session state:\n"
+DELTA_STATE_HEADER = "\n\nChanges to PyMOL session state since last turn:\n"
+MODE_HEADER = "Current mode: "
+OUTPUTS_HEADER = "Outputs from commands executed last turn:\n"
+
+
+def _strip_state(content: str) -> str:
+    """Drop the session-state block (full or delta) from a user message."""
+    for header in (FULL_STATE_HEADER, DELTA_STATE_HEADER):
+        start = content.find(header)
+        if start < 0:
+            continue
+        end = content.find("\n" + MODE_HEADER, start + len(header))
+        if end < 0:
+            return content[:start]
+        return content[:start] + "\n\n[session state omitted]" + content[end:]
+    return content
+
+
+def _truncate_outputs(content: str, limit: int) -> str:
+    """Shorten the command-output block of a user message to `limit` characters."""
+    start = content.find(OUTPUTS_HEADER)
+    if start < 0:
+        return content
+    body = content[start + len(OUTPUTS_HEADER):]
+    if len(body) <= limit:
+        return content
+    return content[:start + len(OUTPUTS_HEADER)] + body[:limit] + f"\n  ... [{len(body) - limit} chars truncated]"
+
+
+class ConversationHistory:
+    """
+    The message list sent to the model, kept within a size budget.
+
+    compact() runs before each new turn. Messages already sent are left
+    byte-identical until the history exceeds `max_chars`, so the prefix
+    cached on the previous request is read back on the next one. Then a
+    single pass brings it down to `compact_to` characters: state blocks
+    older than the last full snapshot are removed (deltas after it are
+    kept, they build on it), command outputs outside the last `keep_turns`
+    turns are truncated, and the oldest turns are dropped; the commands
+    they ran are summarized at the top of the first remaining message.
+    The cache is rebuilt once per pass instead of on every turn.
+    """
+
+    def __init__(
+        self,
+        max_chars: int = HISTORY_MAX_CHARS,
+        keep_turns: int = HISTORY_KEEP_TURNS,
+        output_chars: int = OLD_OUTPUT_MAX_CHARS,
+        compact_to: int = HISTORY_COMPACT_TO,
+    ):
+        self.max_chars = max_chars
+        self.compact_to = min(compact_to, max_chars)
+        self.keep_turns = keep_turns
+        self.output_chars = output_chars
+        self.messages: list[dict] = []
+        self.omitted_turns = 0
+        self.omitted_commands: list[str] = []
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, role: str, content: str) -> None:
+        self.messages.append({"role": role, "content": content})
+
+    def pop(self) -> dict:
+        return self.messages.pop()
+
+    def size(self) -> int:
+        """Total characters of message content."""
+        return sum(len(m["content"]) for m in self.messages)
+
+    def for_request(self) -> list[dict]:
+        """The messages to send, with a summary of dropped turns prepended."""
+        if not self.omitted_turns or not self.messages:
+            return list(self.messages)
+        commands = self.omitted_commands[-30:]
+        summary = f"[Earlier conversation compacted: {self.omitted_turns} turn(s) omitted."
+        if commands:
+            latest = "" if len(commands) == len(self.omitted_commands) else f" (latest {len(commands)})"
+            summary += f" Commands run in them{latest}: " + "; ".join(commands)
+        first = self.messages[0]
+        return [{**first, "content": summary + "]\n\n" + first["content"]}] + self.messages[1:]
+
+    def compact(self) -> bool:
+        """
+        Apply the budget before a new turn is appended.
+
+        Returns True when the remaining history holds only state deltas
+        whose base snapshot was dropped, so the next turn must send the
+        full state again.
+        """
+        if self.size() > self.max_chars:
+            users = [i for i, m in enumerate(self.messages) if m["role"] == "user"]
+            last_full = max(
+                (i for i in users if FULL_STATE_HEADER in self.messages[i]["content"]), default=len(self.messages),
+            )
+            for i in users:
+                if i < last_full:
+                    self.messages[i]["content"] = _strip_state(self.messages[i]["content"])
+
+            # Messages before `recent` are outside the verbatim window
+            recent = max(0, len(self.messages) - 2 * self.keep_turns)
+            for i in users:
+                if i < recent:
+                    self.messages[i]["content"] = _truncate_outputs(self.messages[i]["content"], self.output_chars)
+
+            while recent >= 2 and self.size() > self.compact_to:
+                _, reply = self.messages[:2]
+                del self.messages[:2]
+                recent -= 2
+                self.omitted_turns += 1
+                self.omitted_commands.extend(extract_commands(reply["content"]))
+
+        return not any(
+            FULL_STATE_HEADER in m["content"] for m in self.messages if m["role"] == "user"
+        ) and any(DELTA_STATE_HEADER in m["content"] for m in self.messages if m["role"] == "user")
+
+
 # ---------------------------------------------------------------------------
 # Agent loop
 # ---------------------------------------------------------------------------
 
-def run_agent(start_mode: str = "guided") -> None:
-    client = anthropic.Anthropic()
-    conversation_history: list[dict] = []
-    mode = start_mode
-    pending_outputs: list[str] = []   # command outputs to feed back next turn
+def build_state_context(
+    snapshot: dict,
+    previous: dict | None,
+    full: bool,
+) -> str:
+    """
+    Render the session-state block appended to a user message.
+
+    Sends the whole snapshot when `full` is set or there is no previous
+    snapshot to diff against; otherwise only the changes since `previous`,
+    unless they are longer than STATE_MAX_CHARS (say, 300 objects loaded
+    at once), in which case the budgeted full state goes instead.
+    """
+    if not full and previous is not None:
+        delta = format_session_state_delta(previous, snapshot)
+        if len(delta) <= STATE_MAX_CHARS:
+            return DELTA_STATE_HEADER + delta
+    return FULL_STATE_HEADER + format_session_state(snapshot, max_chars=STATE_MAX_CHARS)
+
+
+def format_metrics(summary: dict[str, dict]) -> str:
+    """One line per command verb: count, total/max wall time, CPU time, peak RSS growth."""
+    if not summary:
+        return "No commands executed yet.\n"
+    lines = [f"{'verb':<14}{'count':>6}{'wall s':>10}{'max s':>9}{'cpu s':>9}{'rss +KiB':>10}"]
+    for verb, stats in sorted(summary.items(), key=lambda item: -item[1]["wall_total_s"]):
+        lines.append(
+            f"{verb:<14}{stats['count']:>6}{stats['wall_total_s']:>10.3f}"
+            f"{stats['wall_max_s']:>9.3f}{stats['cpu_total_s']:>9.3f}{stats['rss_delta_max_kb']:>10}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def report_results(
+    commands: list[str], results: list[dict], echo: bool = True, echo_commands: bool = True,
+) -> list[str]:
+    """
+    Print the outcome of a reply's commands; returns the lines to feed back
+    to the model. Without `echo_commands` only outputs and errors are
+    printed (stream_reply already showed each command as it ran).
+    """
+    say = print if echo else (lambda *args, **kwargs: None)
+    feedback = []
+    for result in results:
+        cmd, output, error = result["command"], result["output"], result["error"]
+        if echo_commands:
+            say(f"[CMD] {cmd}")
+        if error:
+            say(f"      ! ERROR: {error}")
+            feedback.append(f"  Command {cmd!r} failed: {error}")
+            continue
+
+        if output:
+            say(f"      → {output}")
+            feedback.append(f"  {cmd!r} → {output}")
+
+    skipped = commands[len(results):]
+    if skipped:
+        say(f"      ! skipped {len(skipped)} command(s) after the error")
+        feedback.append(
+            "  Not executed after the error: " + ", ".join(repr(c) for c in skipped)
+        )
+
+    if commands:
+        say()
+    return feedback
+
+
+def warmed(commands: Iterable[str], prefetch: bool = True) -> Iterator[str]:
+    """
+    Yield each command once the structures it names are in the local
+    structure cache. Downloads already started for it (from the user's
+    message, or as it streamed in) are waited on rather than repeated; a
+    failed download is left for the command itself to report.
+    """
+    for command in commands:
+        if prefetch:
+            for future in prefetch_refs(command):
+                future.exception()
+        yield command
+
+
+def stream_reply(
+    backend: LLMBackend, system: str, messages: list[dict], prefetch: bool = False,
+) -> tuple[str, list[str], list[dict], dict | None, BackendError | None]:
+    """
+    Stream one LLM reply, printing prose as it arrives and handing each
+    <pymol> command to PyMOL as soon as its closing tag is seen, so command
+    execution overlaps with generation. With `prefetch`, structures a
+    command names start downloading as soon as it is parsed.
+
+    Returns (reply text, commands, execute_batch results, usage, error).
+    If the stream fails, the commands already dispatched still finish and
+    the text received so far is returned with the BackendError (usage is
+    then None).
+
+    Commands run on an executor thread in a copy of the caller's context,
+    so a use_session() binding carries over. An in-process session swaps
+    sys.stdout while a command runs; prose is printed to the stdout in
+    place when the reply started so it never lands in a command's output.
+    """
+    parser = StreamingCommandParser()
+    pending: queue.Queue = queue.Queue()
+    commands: list[str] = []
+    chunks: list[str] = []
+    out = sys.stdout
+    usage = error = None
+
+    print("\nAgent: ", end="", file=out, flush=True)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # One batch fed lazily from the queue; None marks the end of the reply
+        batch = executor.submit(
+            contextvars.copy_context().run,
+            execute_batch, warmed(iter(pending.get, None), prefetch), STOP_ON_ERROR,
+        )
+        try:
+            with backend.stream(system, messages, MAX_TOKENS) as stream:
+                at_line_start = False
+                for delta in stream.text_stream:
+                    chunks.append(delta)
+                    prose, ready = parser.feed(delta)
+                    if prose:
+                        print(prose, end="", file=out, flush=True)
+                        at_line_start = prose.endswith("\n")
+                    for cmd in ready:
+                        if not at_line_start:
+                            print(file=out)
+                        print(f"[CMD ▸] {cmd}", file=out, flush=True)
+                        at_line_start = True
+                        commands.append(cmd)
+                        if prefetch:
+                            prefetch_refs(cmd)
+                        pending.put(cmd)
+            usage = stream.usage
+        except BackendError as e:
+            error = e
+        finally:
+            pending.put(None)
+            print(parser.flush() + "\n", file=out)
+        results = batch.result()
+
+    return "".join(chunks), commands, results, usage, error
+
+
+class AgentSession:
+    """
+    One conversation with the model over the active PyMOL session.
+
+    turn() runs a user message. Simple commands may take the fast path. A
+    cached reply may be replayed. Otherwise the model is called up to
+    `max_steps` times: while a reply's commands produce output or errors,
+    the results go straight back to the model, so it can act on them
+    without waiting for the user, within AGENT_TIME_BUDGET_S of wall-clock
+    time.
+
+    With a `response_cache`, the first call of a turn is looked up by
+    message, mode, session state and model. With `fast_path`, input that
+    is a single simple PyMOL command, or a common phrasing of one (see
+    intent_router), runs without a model call and is recorded in the
+    history like a model reply. With `prefetch`, PDB IDs and files named in
+    the message start loading into the local caches while the model is
+    still answering, and those named by commands are fetched in parallel
+    before the commands run. `echo` prints the conversation as it happens.
+    """
+
+    def __init__(
+        self,
+        backend: LLMBackend,
+        system: str,
+        mode: str = "guided",
+        state_delta: bool = False,
+        stream: bool = False,
+        max_steps: int = MAX_AGENT_STEPS,
+        response_cache: ResponseCache | None = None,
+        fast_path: bool = FAST_PATH,
+        prefetch: bool = PREFETCH,
+        echo: bool = True,
+    ):
+        self.backend = backend
+        self.system = system
+        self.mode = mode
+        self.state_delta = state_delta
+        self.stream = stream
+        self.max_steps = max_steps
+        self.response_cache = response_cache
+        self.fast_path = fast_path
+        self.prefetch = prefetch
+        self.echo = echo
+
+        self.history = ConversationHistory(HISTORY_MAX_CHARS, HISTORY_KEEP_TURNS, OLD_OUTPUT_MAX_CHARS, HISTORY_COMPACT_TO)
+        self.usage_log: list[dict] = []        # token usage of every LLM call
+        self.pending_outputs: list[str] = []   # command outputs to feed back next turn
+        self.last_snapshot: dict | None = None  # state the model saw last turn
+        self.turns_since_full = 0
+        self.force_full_state = False
+
+    def _say(self, *args, **kwargs) -> None:
+        if self.echo:
+            print(*args, **kwargs)
+
+    def turn(self, user_input: str) -> dict:
+        """
+        Handle one user message. Returns a record of the turn: the last
+        reply, every command run and its result, how it was answered
+        (fast_path / cached / steps), any backend error, and timings in
+        seconds for state collection, model calls and command execution.
+        """
+        record = {
+            "reply": None, "commands": [], "results": [], "steps": 0,
+            "fast_path": False, "cached": False, "error": None,
+            "timings": {"state_s": 0.0, "llm_s": 0.0, "execute_s": 0.0},
+        }
+        timings = record["timings"]
+        history = self.history
+
+        # --- fast path: simple commands skip the model ---
+        command = route_intent(user_input, is_direct_command, DIRECT_COMMANDS) if self.fast_path else None
+        if command is not None:
+            self._say("\n[fast path] run directly, without the model")
+            t = time.perf_counter()
+            results = execute_batch([command], stop_on_error=STOP_ON_ERROR)
+            timings["execute_s"] += time.perf_counter() - t
+            history.append("user", user_input)
+            history.append("assistant", f"<pymol>{command}</pymol>")
+            self.pending_outputs.extend(report_results([command], results, echo=self.echo))
+            record.update(reply=f"<pymol>{command}</pymol>", commands=[command], results=results, fast_path=True)
+            return record
+
+        # --- agent steps: call the LLM, run its commands, feed the results back ---
+        if self.prefetch:
+            prefetch_refs(user_input)   # downloads overlap the model call
+        message = user_input
+        started = time.monotonic()
+        for step in range(1, self.max_steps + 1):
+            # Compact first: it may drop the state later deltas build on
+            if history.compact():
+                self.force_full_state = True
+
+            # --- build context to append to the message ---
+            t = time.perf_counter()
+            snapshot = get_session_snapshot(STATE_COLLECTOR)
+            send_full = (
+                not self.state_delta
+                or self.force_full_state
+                or self.turns_since_full >= STATE_FULL_EVERY
+            )
+            state_context = build_state_context(snapshot, self.last_snapshot, full=send_full)
+            send_full = state_context.startswith(FULL_STATE_HEADER)   # a delta may fall back to full
+            context_parts = [state_context, MODE_HEADER + self.mode]
+            timings["state_s"] += time.perf_counter() - t
+            outputs, self.pending_outputs = self.pending_outputs, []
+            if outputs:
+                context_parts.append(OUTPUTS_HEADER + "\n".join(outputs))
+
+            history.append("user", message + "\n".join(context_parts))
+
+            # --- replay a cached reply to the same request, if any ---
+            cache_key = cached = None
+            if self.response_cache is not None and step == 1 and not outputs:
+                cache_key = self.response_cache.key(
+                    user_input, self.mode, session_fingerprint(snapshot), self.backend.model,
+                )
+                cached = self.response_cache.get(cache_key)
+
+            # --- call the LLM (streaming runs commands as they arrive) ---
+            t = time.perf_counter()
+            stream_error = None
+            try:
+                messages = history.for_request()
+                if cached is not None:
+                    reply, usage = cached, None
+                elif self.stream:
+                    reply, commands, results, usage, stream_error = stream_reply(
+                        self.backend, self.system, messages, self.prefetch,
+                    )
+                    if stream_error is not None and not reply:
+                        raise stream_error
+                else:
+                    reply, usage = self.backend.complete(self.system, messages, MAX_TOKENS)
+            except BackendError as e:
+                self._say(f"[ERROR] API call failed: {e}\n")
+                history.pop()   # drop the failed turn
+                self.pending_outputs = outputs
+                record["error"] = str(e)
+                break
+            finally:
+                timings["llm_s"] += time.perf_counter() - t
+
+            # The model has now seen this state; later deltas are relative to it
+            self.last_snapshot = snapshot
+            self.turns_since_full = 1 if send_full else self.turns_since_full + 1
+            self.force_full_state = False
+            if usage is not None:
+                self.usage_log.append(usage)
+
+            if cached is not None or not self.stream:
+                self._say(f"\nAgent{' (cached)' if cached is not None else ''}: {reply}\n")
+
+                # --- execute commands ---
+                t = time.perf_counter()
+                commands = extract_commands(reply)
+                if self.prefetch:
+                    for command in commands:
+                        prefetch_refs(command)
+                results = execute_batch(warmed(commands, self.prefetch), stop_on_error=STOP_ON_ERROR)
+                timings["execute_s"] += time.perf_counter() - t
+
+            # A reply cut off mid-stream is kept with the results of the
+            # commands it had already issued, marked so the model knows
+            if stream_error is not None:
+                self._say(f"[ERROR] API call failed mid-reply: {stream_error}\n")
+                record["error"] = str(stream_error)
+            history.append("assistant", reply if stream_error is None else reply + STREAM_INTERRUPTED_NOTE)
+            feedback = report_results(
+                commands, results, echo=self.echo, echo_commands=cached is not None or not self.stream,
+            )
+            record["reply"] = reply
+            record["commands"].extend(commands)
+            record["results"].extend(results)
+            record["steps"] = step
+            record["cached"] = record["cached"] or cached is not None
+
+            # Only replies whose commands all ran cleanly are worth replaying
+            if cache_key and cached is None and stream_error is None and len(results) == len(commands) \
+                    and not any(r["error"] for r in results):
+                self.response_cache.put(
+                    cache_key, reply, prompt=user_input, mode=self.mode, model=self.backend.model,
+                )
+            self.pending_outputs.extend(feedback)
+
+            # Commands without output give the model nothing new to act on
+            if not feedback or stream_error is not None:
+                break
+            if step == self.max_steps or time.monotonic() - started > AGENT_TIME_BUDGET_S:
+                self._say("[agent] step limit reached; results will be sent with your next message\n")
+                break
+            self._say(f"[agent] step {step + 1}: sending command results back to the model")
+            message = FOLLOW_UP_MESSAGE
 
+        return record
+
+
+def run_agent(
+    start_mode: str = "guided",
+    state_delta: bool = False,
+    supervised: bool = True,
+    metrics_log: str | None = None,
+    stream: bool = False,
+    backend: LLMBackend | None = None,
+    max_steps: int = MAX_AGENT_STEPS,
+    response_cache: ResponseCache | None = None,
+    fast_path: bool = FAST_PATH,
+    prefetch: bool = PREFETCH,
+) -> None:
+    """Interactive loop around one AgentSession."""
+    if supervised:
+        start_supervised_session()
+    if metrics_log:
+        set_metrics_log(metrics_log)
+
+    backend = backend or make_backend("anthropic", MODEL)
     with open(SYSTEM_PROMPT_FILE) as f:
-        system_prompt = f.read()
+        system = f.read()
+    agent = AgentSession(
+        backend, system,
+        mode=start_mode,
+        state_delta=state_delta,
+        stream=stream,
+        max_steps=max_steps,
+        response_cache=response_cache,
+        fast_path=fast_path,
+        prefetch=prefetch,
+    )
 
-    print(f"PyMOL Agent ready (mode: {mode}).")
+    print(f"PyMOL Agent ready (mode: {agent.mode}).")
     print("Type 'guided' or 'expert' to switch modes, 'quit' to exit.\n")
 
     while True:
@@ -73,64 +703,203 @@ def run_agent(start_mode: str = "guided") -> None:
             break
 
         if user_input.lower() in ("guided", "expert"):
-            mode = user_input.lower()
-            print(f"Switched to {mode} mode.\n")
+            agent.mode = user_input.lower()
+            print(f"Switched to {agent.mode} mode.\n")
             continue
 
-        # --- build context to append to user message ---
-        context_parts = [
-            f"\n\nCurrent PyMOL session state:\n{get_session_state()}",
-            f"Current mode: {mode}",
-        ]
-        if pending_outputs:
-            context_parts.append(
-                "Outputs from commands executed last turn:\n" + "\n".join(pending_outputs)
-            )
-            pending_outputs = []
+        if user_input.lower() == "state":
+            agent.force_full_state = True
+            print("Full session state will be sent with your next message.\n")
+            continue
 
-        conversation_history.append({
-            "role": "user",
-            "content": user_input + "\n".join(context_parts),
-        })
+        if user_input.lower() == "metrics":
+            print(format_metrics(get_command_metrics()))
+            continue
 
-        # --- call the LLM ---
-        try:
-            response = client.messages.create(
-                model=MODEL,
-                max_tokens=MAX_TOKENS,
-                system=system_prompt,
-                messages=conversation_history,
-            )
-        except anthropic.APIError as e:
-            print(f"[ERROR] API call failed: {e}\n")
-            conversation_history.pop()   # drop the failed turn
+        if user_input.lower() == "usage":
+            print(format_usage(agent.usage_log))
+            if response_cache is not None:
+                print(response_cache.stats() + "\n")
             continue
 
-        reply = response.content[0].text
-        conversation_history.append({"role": "assistant", "content": reply})
+        agent.turn(user_input)
 
-        print(f"\nAgent: {reply}\n")
+    backend.close()
+    close_session()
 
-        # --- execute commands ---
-        commands = extract_commands(reply)
-        for cmd in commands:
-            print(f"[CMD] {cmd}")
-            try:
-                output = execute_command(cmd)
-            except Exception as e:
-                output = f"ERROR: {e}"
-                print(f"      ! {output}")
-                pending_outputs.append(f"  Command {cmd!r} failed: {e}")
+
+# ---------------------------------------------------------------------------
+# Batch mode
+# ---------------------------------------------------------------------------
+
+def load_jobs(path: str) -> list[dict]:
+    """
+    Read a batch file: one JSON object per line with
+
+        "prompt"   a request, or a list of requests run as consecutive turns
+        "id"       optional job name (default: job-<line number>)
+        "preload"  optional path or PDB ID (or a list) loaded before the prompt
+        "outputs"  optional paths the job is expected to write (e.g. figures)
+        "mode"     optional "guided" / "expert"
+    """
+    jobs = []
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
                 continue
+            job = json.loads(line)
+            if "prompt" not in job:
+                raise ValueError(f"{path}:{n}: job has no \"prompt\"")
+            job.setdefault("id", f"job-{n}")
+            jobs.append(job)
+    return jobs
 
-            if output:
-                print(f"      → {output}")
-                pending_outputs.append(f"  {cmd!r} → {output}")
 
-        if commands:
-            print()
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    return [value] if isinstance(value, str) else list(value)
 
-    close_session()
+
+def run_job(job: dict, backend: LLMBackend, system: str, **session_kwargs) -> dict:
+    """
+    Run one batch job on a freshly reset session. Returns its result
+    record: status ("ok", "incomplete" when expected outputs are missing,
+    "error"), the commands run and their errors, token usage and per-stage
+    timings in seconds.
+    """
+    started_wall = time.time()
+    t0 = time.perf_counter()
+    timings = {"reset_s": 0.0, "preload_s": 0.0, "state_s": 0.0, "llm_s": 0.0, "execute_s": 0.0, "verify_s": 0.0}
+    result = {"id": job["id"], "status": "ok", "error": None, "reply": None, "commands": [],
+              "command_errors": [], "missing_outputs": [], "steps": 0, "usage": None, "timings": timings}
+
+    try:
+        t = time.perf_counter()
+        reset_session()
+        timings["reset_s"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if session_kwargs.get("prefetch", PREFETCH):
+            for future in prefetch_refs(" ".join(_as_list(job.get("preload")))):
+                future.exception()   # wait for run_batch's download rather than start another
+        names = [load_structure(item) for item in _as_list(job.get("preload"))]
+        if names:
+            loaded = get_session_snapshot(STATE_COLLECTOR)["objects"]
+            failed = [item for item, name in zip(_as_list(job["preload"]), names) if name not in loaded]
+            if failed:
+                raise RuntimeError(f"could not load {', '.join(failed)}")
+        timings["preload_s"] = time.perf_counter() - t
+
+        outputs = _as_list(job.get("outputs"))
+        for path in outputs:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        session_kwargs = {**session_kwargs, "mode": job.get("mode", session_kwargs.get("mode", "guided"))}
+        agent = AgentSession(backend, system, echo=False, **session_kwargs)
+        for prompt in _as_list(job["prompt"]):
+            record = agent.turn(prompt)
+            for key, value in record["timings"].items():
+                timings[key] += value
+            result["reply"] = record["reply"]
+            result["commands"].extend(record["commands"])
+            result["command_errors"].extend(
+                {"command": r["command"], "error": r["error"]} for r in record["results"] if r["error"]
+            )
+            result["steps"] += record["steps"]
+            if record["error"]:
+                raise BackendError(record["error"])
+        if agent.usage_log:
+            result["usage"] = {key: sum(u[key] for u in agent.usage_log) for key in agent.usage_log[0]}
+
+        t = time.perf_counter()
+        result["missing_outputs"] = [
+            path for path in outputs
+            if not os.path.exists(path) or os.path.getmtime(path) < started_wall
+        ]
+        timings["verify_s"] = time.perf_counter() - t
+        if result["missing_outputs"]:
+            result["status"] = "incomplete"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    timings["total_s"] = time.perf_counter() - t0
+    return result
+
+
+def run_batch(
+    path: str,
+    results_path: str | None = None,
+    concurrency: int = BATCH_CONCURRENCY,
+    supervised: bool = True,
+    metrics_log: str | None = None,
+    backend: LLMBackend | None = None,
+    **session_kwargs,
+) -> list[dict]:
+    """
+    Run every job in the batch file `path` and write one JSON result line
+    per job to `results_path` (default: <path>.results.jsonl), in
+    completion order. Jobs are independent: with a supervised session each
+    of the `concurrency` threads drives its own pooled PyMOL worker, which
+    is reset between jobs.
+    """
+    jobs = load_jobs(path)
+    results_path = results_path or os.path.splitext(path)[0] + ".results.jsonl"
+    backend = backend or make_backend("anthropic", MODEL)
+    with open(SYSTEM_PROMPT_FILE) as f:
+        system = f.read()
+
+    if not supervised:
+        concurrency = 1
+        if metrics_log:
+            set_metrics_log(metrics_log)
+    else:
+        start_worker_pool(concurrency, prestart=concurrency)
+
+    configured = threading.local()
+    results = []
+
+    def job_runner(job: dict) -> dict:
+        if not supervised:
+            return run_job(job, backend, system, **session_kwargs)
+        with use_session(threading.current_thread().name):
+            if metrics_log and not getattr(configured, "metrics", False):
+                set_metrics_log(metrics_log)
+                configured.metrics = True
+            return run_job(job, backend, system, **session_kwargs)
+
+    if session_kwargs.get("prefetch", PREFETCH):
+        # Warm the structure cache for every job up front, in parallel
+        for job in jobs:
+            prefetch_refs(" ".join(_as_list(job.get("preload")) + _as_list(job["prompt"])))
+
+    print(f"Running {len(jobs)} job(s) from {path} with {concurrency} worker(s)")
+    t0 = time.perf_counter()
+    try:
+        with open(results_path, "w") as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(job_runner, job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                print(f"[{len(results)}/{len(jobs)}] {result['id']}: {result['status']} "
+                      f"in {result['timings']['total_s']:.1f}s"
+                      + (f" ({result['error']})" if result["error"] else ""))
+    finally:
+        backend.close()
+        if supervised:
+            close_worker_pool()
+        else:
+            close_session()
+
+    elapsed = time.perf_counter() - t0
+    counts = {status: sum(r["status"] == status for r in results) for status in ("ok", "incomplete", "error")}
+    print(f"Done: {counts['ok']} ok, {counts['incomplete']} incomplete, {counts['error']} failed "
+          f"in {elapsed:.1f}s ({len(results) / elapsed * 60:.1f} jobs/min); results in {results_path}")
+    return results
 
 
 # ---------------------------------------------------------------------------
@@ -144,6 +913,152 @@ if __name__ == "__main__":
         action="store_true",
         help="Start in expert mode (minimal explanations)",
     )
+    parser.add_argument(
+        "--state-delta",
+        action="store_true",
+        help=f"Send session-state changes instead of the full state "
+             f"(full snapshot every {STATE_FULL_EVERY} turns)",
+    )
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run PyMOL inside the agent process instead of a supervised worker "
+             "(commands then have no time budget)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream replies and run each command as soon as it is complete",
+    )
+    parser.add_argument(
+        "--backend",
+        default="anthropic",
+        metavar="SPEC",
+        help=f"LLM backend: {', '.join(BACKENDS)} (stub[:replies.jsonl], "
+             f"openai:http://host:port/v1; default anthropic)",
+    )
+    parser.add_argument(
+        "--model",
+        default=MODEL,
+        help=f"Model name passed to the backend (default {MODEL})",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        default=MAX_AGENT_STEPS,
+        metavar="N",
+        help=f"Model calls per message while commands return results (default {MAX_AGENT_STEPS}; 1 disables follow-ups)",
+    )
+    parser.add_argument(
+        "--no-fast-path",
+        action="store_true",
+        help="Send every message to the model, even plain PyMOL commands",
+    )
+    parser.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="Only download structures when a command loads them, not ahead of time",
+    )
+    parser.add_argument(
+        "--response-cache",
+        metavar="DIR",
+        help="Reuse replies to repeated requests against the same session state, cached in DIR",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=RESPONSE_CACHE_TTL_H,
+        metavar="HOURS",
+        help=f"Expire cached replies after HOURS (default {RESPONSE_CACHE_TTL_H:g})",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="JOBS.jsonl",
+        help="Run the requests in JOBS.jsonl headlessly instead of the interactive loop",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=BATCH_CONCURRENCY,
+        metavar="N",
+        help=f"--batch: jobs to run at once, each on its own PyMOL worker (default {BATCH_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--results",
+        metavar="PATH",
+        help="--batch: where to write the per-job results (default JOBS.results.jsonl)",
+    )
+    parser.add_argument(
+        "--structure-cache",
+        metavar="DIR",
+        help="Directory of the local structure cache used for PDB IDs "
+             "(default $PYMOL_AGENT_STRUCTURE_CACHE or ~/.cache/pymol_agent/structures)",
+    )
+    parser.add_argument(
+        "--structure-mirror",
+        metavar="DIR",
+        help="Serve PDB IDs from this local mirror directory (implies --offline)",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never download structures; use only the cache and the mirror",
+    )
+    parser.add_argument(
+        "--no-sidecars",
+        action="store_true",
+        help="Always parse structure files instead of reloading large ones from pre-parsed sidecars",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        metavar="PATH",
+        help="Append per-command timing and resource samples to PATH as JSONL",
+    )
     args = parser.parse_args()
 
-    run_agent(start_mode="expert" if args.expert else "guided")
+    # Structure cache and sidecar settings travel in the environment so PyMOL workers inherit them
+    if args.structure_cache:
+        os.environ["PYMOL_AGENT_STRUCTURE_CACHE"] = os.path.abspath(args.structure_cache)
+    if args.structure_mirror:
+        os.environ["PYMOL_AGENT_STRUCTURE_MIRROR"] = os.path.abspath(args.structure_mirror)
+    if args.offline:
+        os.environ["PYMOL_AGENT_OFFLINE"] = "1"
+    if args.no_sidecars:
+        os.environ["PYMOL_AGENT_SIDECARS"] = "0"
+
+    backend = make_backend(args.backend, args.model, api_key=os.environ.get("OPENAI_API_KEY"))
+    response_cache = ResponseCache(
+        args.response_cache,
+        max_bytes=RESPONSE_CACHE_MAX_MB * 1024 * 1024,
+        ttl_s=args.response_cache_ttl * 3600,
+    ) if args.response_cache else None
+
+    if args.batch:
+        results = run_batch(
+            args.batch,
+            results_path=args.results,
+            concurrency=max(1, args.concurrency),
+            supervised=not args.in_process,
+            metrics_log=args.metrics_log,
+            backend=backend,
+            mode="expert" if args.expert else "guided",
+            state_delta=args.state_delta,
+            max_steps=max(1, args.max_steps),
+            response_cache=response_cache,
+            fast_path=not args.no_fast_path,
+            prefetch=not args.no_prefetch,
+        )
+        sys.exit(0 if all(r["status"] == "ok" for r in results) else 1)
+
+    run_agent(
+        start_mode="expert" if args.expert else "guided",
+        state_delta=args.state_delta,
+        supervised=not args.in_process,
+        metrics_log=args.metrics_log,
+        stream=args.stream,
+        backend=backend,
+        max_steps=max(1, args.max_steps),
+        fast_path=not args.no_fast_path,
+        prefetch=not args.no_prefetch,
+        response_cache=response_cache,
+    )
@@ -0,0 +1,78 @@
+"""
+On-disk Store Helpers
+
+Building blocks shared by the size-bounded caches (structure_cache,
+structure_sidecar, response_cache): content hashing, atomic writes,
+best-effort removal, and least-recently-used eviction by file mtime,
+which readers refresh with touch() on every hit. Fixes to eviction or
+file handling belong here so that every cache gets them.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+
+
+def sha256_file(path: str) -> str:
+    """SHA-256 hex digest of the file at `path`, read in 1 MB blocks."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Write `data` to `path` through a temporary file in the same directory."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        remove_quietly(tmp)
+        raise
+
+
+def remove_quietly(path: str) -> None:
+    """Delete `path`, ignoring files that are already gone or locked."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def touch(path: str) -> None:
+    """Mark `path` as recently used for evict_lru()."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def evict_lru(directory: str, suffix: str, max_bytes: int, max_age_s: float | None = None) -> None:
+    """
+    Delete the files in `directory` ending in `suffix`, least recently used
+    first, until they total at most `max_bytes`; files unused for more than
+    `max_age_s` seconds are deleted regardless.
+    """
+    entries = []
+    with os.scandir(directory) as it:
+        for item in it:
+            if not item.name.endswith(suffix):
+                continue
+            try:
+                st = item.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, item.path))
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+        expired = max_age_s is not None and now - mtime > max_age_s
+        if total <= max_bytes and not expired:
+            continue
+        remove_quietly(path)
+        total -= size
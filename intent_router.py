@@ -0,0 +1,134 @@
+"""
+Local Fast-Path Intent Router
+
+Maps user input that is already a PyMOL command ("show sticks, organic"),
+or one of a few common phrasings ("hide everything", "bg white", "zoom
+chain A", "color the ligand green"), to a single PyMOL command, so the
+agent can run it without a model round-trip.
+
+The router only proposes candidates. Each one is checked against the live
+session by a validator (pymol_interface.is_direct_command), and the first
+that passes is used. Anything unmatched or invalid goes to the model as
+usual, so a false negative costs one LLM call and a false positive needs
+a phrase that is also a valid command.
+"""
+
+import re
+from collections.abc import Callable
+
+# Representation words as people type them -> PyMOL representation names
+_REP_ALIASES = {
+    "stick": "sticks", "line": "lines", "sphere": "spheres", "dot": "dots",
+    "label": "labels", "cartoons": "cartoon", "ribbons": "ribbon",
+    "surfaces": "surface", "meshes": "mesh",
+}
+
+# Phrases for common selections -> PyMOL selection expressions
+_NAMED_TARGETS = [
+    (re.compile(r"(?:the )?(?:whole |entire )?(?:everything|all|structure|scene|molecule)", re.I), "all"),
+    (re.compile(r"(?:the |all )?(?:waters?|solvent)", re.I), "solvent"),
+    (re.compile(r"(?:the |all )?ligands?", re.I), "organic"),
+    (re.compile(r"(?:the |all )?hydrogens?", re.I), "hydro"),
+    (re.compile(r"(?:the )?proteins?", re.I), "polymer.protein"),
+    (re.compile(r"(?:the )?(?:dna|rna|nucleic acids?)", re.I), "polymer.nucleic"),
+]
+_CHAIN_RE = re.compile(r"chains? (\w(?:\s*(?:,|\+|and)\s*\w)*)", re.I)
+_RESI_RE = re.compile(r"(?:residues?|resi) (-?\d+)(?:\s*(?:-|to)\s*(-?\d+))?", re.I)
+_QUALIFIER_RE = re.compile(r" (?:of|in|on|from) ", re.I)
+
+
+def _target(phrase: str) -> str:
+    """Turn a phrase like "residues 10 to 20 of chain A" into a selection."""
+    parts = []
+    for part in _QUALIFIER_RE.split(phrase.strip()):
+        part = part.strip()
+        for pattern, selection in _NAMED_TARGETS:
+            if pattern.fullmatch(part):
+                parts.append(selection)
+                break
+        else:
+            if m := _CHAIN_RE.fullmatch(part):
+                parts.append("chain " + "+".join(re.findall(r"\w", re.sub(r"\band\b", ",", m.group(1)))))
+            elif m := _RESI_RE.fullmatch(part):
+                parts.append("resi " + (f"{m.group(1)}-{m.group(2)}" if m.group(2) else m.group(1)))
+            else:
+                parts.append(re.sub(r"^the ", "", part, flags=re.I))
+    return " and ".join(f"({p})" if " " in p and len(parts) > 1 else p for p in parts)
+
+
+def _rep(word: str) -> str:
+    word = word.lower()
+    return _REP_ALIASES.get(word, word)
+
+
+# (pattern, builder) pairs tried in order; builders return a command string
+_RULES: list[tuple[re.Pattern, Callable[[re.Match], str]]] = [
+    (re.compile(r"(?:hide|clear) (?:everything|all)", re.I),
+     lambda m: "hide everything"),
+    (re.compile(r"bg (\w+)", re.I),
+     lambda m: f"bg_color {m.group(1).lower()}"),
+    (re.compile(r"(?:(?:set|make|change|turn) )?(?:the )?background(?: colou?r)?(?: to)? (\w+)", re.I),
+     lambda m: f"bg_color {m.group(1).lower()}"),
+    (re.compile(r"(?:make it |use a )?(\w+) background", re.I),
+     lambda m: f"bg_color {m.group(1).lower()}"),
+    (re.compile(r"zoom(?: out| all| to fit| on everything)?|(?:reset|fit) (?:the )?zoom", re.I),
+     lambda m: "zoom"),
+    (re.compile(r"(?:zoom|focus)(?: in)?(?: on| to| into)? (.+)", re.I),
+     lambda m: f"zoom {_target(m.group(1))}"),
+    (re.compile(r"(?:center|centre)(?: on)? (.+)", re.I),
+     lambda m: f"center {_target(m.group(1))}"),
+    (re.compile(r"reset(?: the)?(?: view| camera)?", re.I),
+     lambda m: "reset"),
+    (re.compile(r"colou?r (?:everything |it |all )?by chains?", re.I),
+     lambda m: "util.cbc"),
+    (re.compile(r"colou?r (.+?) by chains?", re.I),
+     lambda m: f"util.cbc {_target(m.group(1))}"),
+    (re.compile(r"(?:colou?r|make|paint) (.+?) (?:in |to )?(\w+)", re.I),
+     lambda m: f"color {m.group(2).lower()}, {_target(m.group(1))}"),
+    (re.compile(r"(?:show|display|draw) (.+?) (?:as|in) (\w+)", re.I),
+     lambda m: f"show_as {_rep(m.group(2))}, {_target(m.group(1))}"),
+    (re.compile(r"(show|hide) (?:the )?(\w+) (?:for|of|on) (.+)", re.I),
+     lambda m: f"{m.group(1).lower()} {_rep(m.group(2))}, {_target(m.group(3))}"),
+    (re.compile(r"(show|hide) (?:the |all )?(\w+)", re.I),
+     lambda m: f"{m.group(1).lower()} {_rep(m.group(2))}"),
+    (re.compile(r"hide (.+)", re.I),
+     lambda m: f"hide everything, {_target(m.group(1))}"),
+    (re.compile(r"(?:remove|delete) (?:the |all )?(waters?|solvent|hydrogens?)", re.I),
+     lambda m: f"remove {_target(m.group(1))}"),
+]
+
+_POLITE_RE = re.compile(r"^(?:please|now|ok(?:ay)?|then),?\s+|[\s,]+please$|[.!]+$", re.I)
+
+
+def candidates(text: str) -> list[str]:
+    """Commands `text` may stand for, most literal first (unvalidated)."""
+    text = " ".join(text.split())
+    previous = None
+    while previous != text:
+        previous, text = text, _POLITE_RE.sub("", text).strip()
+    if not text:
+        return []
+
+    found = [text]   # already PyMOL syntax?
+    for pattern, build in _RULES:
+        m = pattern.fullmatch(text)
+        if m:
+            command = build(m)
+            if command not in found:
+                found.append(command)
+    return found
+
+
+def route(text: str, is_valid: Callable[[str], bool], verbs=None) -> str | None:
+    """
+    The command to run directly for `text`, or None to ask the model.
+
+    `is_valid` checks a candidate against the session; `verbs`, if given,
+    skips candidates whose verb could never pass, avoiding the call.
+    """
+    for command in candidates(text):
+        if verbs is not None and command.split(None, 1)[0] not in verbs:
+            continue
+        if is_valid(command):
+            return command
+    return None
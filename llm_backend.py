@@ -0,0 +1,411 @@
+"""
+LLM Backends
+
+The agent talks to the model through a small interface so the PyMOL side
+can be exercised and load-tested without network access or API spend:
+
+    AnthropicBackend   the Anthropic messages API (prompt caching, streaming)
+    OpenAIBackend      any OpenAI-compatible /chat/completions endpoint, over
+                       persistent http.client connections (local model
+                       servers, or the llm_stub HTTP server)
+    stub               AnthropicBackend around the in-process StubClient
+
+Every backend takes a plain system prompt and plain-string messages and
+returns usage as {"input", "cache_read", "cache_write", "output"} token
+counts. Transient failures (connection errors, 429, 5xx) are retried with
+full-jitter exponential backoff; anything else, or a failure that outlives
+the retries, raises BackendError.
+"""
+
+import contextlib
+import http.client
+import json
+import random
+import threading
+import time
+from collections.abc import Iterator
+from urllib.parse import urlsplit
+
+RETRIES = 3               # extra attempts after the first failure
+BACKOFF_BASE_S = 0.5      # first retry waits up to this long ...
+BACKOFF_MAX_S = 8.0       # ... doubling per attempt, capped here
+TIMEOUT_S = 120.0         # per-request socket timeout
+
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+
+class BackendError(RuntimeError):
+    """The model call failed and was not (or no longer) worth retrying."""
+
+
+class _Retryable(Exception):
+    """Internal: a transient failure; `cause` is the original exception."""
+
+    def __init__(self, cause: Exception):
+        super().__init__(str(cause))
+        self.cause = cause
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE_S, cap: float = BACKOFF_MAX_S) -> float:
+    """Full-jitter delay before retry number `attempt` (0-based)."""
+    return random.uniform(0.0, min(cap, base * 2 ** attempt))
+
+
+def empty_usage() -> dict:
+    return {"input": 0, "cache_read": 0, "cache_write": 0, "output": 0}
+
+
+# ---------------------------------------------------------------------------
+# Interface
+# ---------------------------------------------------------------------------
+
+class LLMBackend:
+    """
+    Base class. Subclasses implement _complete() and _stream(); callers use
+    complete() and stream(), which add the retry policy.
+    """
+
+    name = "base"
+
+    def __init__(self, model: str, retries: int = RETRIES):
+        self.model = model
+        self.retries = retries
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(model={self.model!r})"
+
+    def _with_retries(self, attempt_call):
+        for attempt in range(self.retries + 1):
+            try:
+                return attempt_call()
+            except _Retryable as e:
+                if attempt == self.retries:
+                    raise BackendError(f"{self.name}: {e.cause} (after {attempt + 1} attempts)") from e.cause
+                time.sleep(backoff_delay(attempt))
+
+    def complete(self, system: str, messages: list[dict], max_tokens: int) -> tuple[str, dict]:
+        """Return (reply text, usage) for one request."""
+        return self._with_retries(lambda: self._complete(system, messages, max_tokens))
+
+    @contextlib.contextmanager
+    def stream(self, system: str, messages: list[dict], max_tokens: int):
+        """
+        Stream one reply. Yields a handle whose `text_stream` iterates over
+        text deltas; its `usage` is filled in once the stream is exhausted.
+        Only opening the stream is retried: once text has been delivered a
+        failure raises BackendError.
+        """
+        handle = self._with_retries(lambda: self._stream(system, messages, max_tokens))
+        try:
+            yield handle
+        except _Retryable as e:
+            raise BackendError(f"{self.name}: stream interrupted: {e.cause}") from e.cause
+        finally:
+            handle.close()
+
+    def close(self) -> None:
+        """Release connections held by the backend."""
+
+    # Subclass hooks
+    def _complete(self, system: str, messages: list[dict], max_tokens: int) -> tuple[str, dict]:
+        raise NotImplementedError
+
+    def _stream(self, system: str, messages: list[dict], max_tokens: int) -> "StreamHandle":
+        raise NotImplementedError
+
+
+class StreamHandle:
+    """Text deltas of one streamed reply plus its usage once complete."""
+
+    def __init__(self, deltas: Iterator[str], on_close=None):
+        self.usage = empty_usage()
+        self._deltas = deltas
+        self._on_close = on_close
+
+    @property
+    def text_stream(self) -> Iterator[str]:
+        return self._deltas
+
+    def close(self) -> None:
+        if self._on_close is not None:
+            self._on_close()
+            self._on_close = None
+
+
+# ---------------------------------------------------------------------------
+# Anthropic
+# ---------------------------------------------------------------------------
+
+def cacheable_system(system_prompt: str) -> list[dict]:
+    """The static system prompt as a single cache-marked block."""
+    return [{"type": "text", "text": system_prompt, "cache_control": _CACHE_CONTROL}]
+
+
+def with_cache_breakpoint(messages: list[dict]) -> list[dict]:
+    """
+    Copy of `messages` with a cache breakpoint on the last assistant reply.
+
+    The newest user message carries this turn's session state and outputs
+    and is never sent again as is, but everything up to the reply before
+    it stays byte-identical (see ConversationHistory.compact), so it
+    becomes a cached prefix that the next request reads back instead of
+    reprocessing. The stored history itself keeps plain string content.
+    """
+    for i in range(len(messages) - 2, -1, -1):
+        if messages[i]["role"] == "assistant":
+            break
+    else:
+        return messages
+    marked = messages[i]
+    content = marked["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    content = [dict(block) for block in content]
+    content[-1]["cache_control"] = _CACHE_CONTROL
+    return messages[:i] + [{**marked, "content": content}] + messages[i + 1:]
+
+
+def usage_record(usage) -> dict:
+    """Token counts of one Anthropic response, including prompt-cache reads and writes."""
+    return {
+        "input": usage.input_tokens,
+        "cache_read": getattr(usage, "cache_read_input_tokens", 0) or 0,
+        "cache_write": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+        "output": usage.output_tokens,
+    }
+
+
+class AnthropicBackend(LLMBackend):
+    """
+    The Anthropic messages API with prompt caching on the system prompt and
+    the conversation prefix. One client is kept for the backend's lifetime
+    so its HTTP connection pool is reused across turns; the SDK's own
+    retries are disabled in favour of the backend's policy.
+    """
+
+    name = "anthropic"
+
+    def __init__(self, model: str, client=None, retries: int = RETRIES):
+        super().__init__(model, retries)
+        try:
+            import anthropic
+        except ImportError:
+            raise ImportError("anthropic is required for the Anthropic backend. Install with: pip install anthropic")
+        self._anthropic = anthropic
+        self.client = client or anthropic.Anthropic(max_retries=0, timeout=TIMEOUT_S)
+        self._cached_system: tuple[str, list[dict]] | None = None
+
+    def _request(self, system: str, messages: list[dict], max_tokens: int) -> dict:
+        if self._cached_system is None or self._cached_system[0] != system:
+            self._cached_system = (system, cacheable_system(system))
+        return {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "system": self._cached_system[1],
+            "messages": with_cache_breakpoint(messages),
+        }
+
+    def _translate(self, e: Exception) -> Exception:
+        anthropic = self._anthropic
+        if isinstance(e, (anthropic.APIConnectionError, anthropic.RateLimitError, anthropic.InternalServerError)):
+            return _Retryable(e)
+        if isinstance(e, anthropic.APIStatusError) and e.status_code in (408, 409, 429, 529):
+            return _Retryable(e)
+        return BackendError(f"{self.name}: {e}")
+
+    def _complete(self, system, messages, max_tokens):
+        try:
+            response = self.client.messages.create(**self._request(system, messages, max_tokens))
+        except self._anthropic.APIError as e:
+            raise self._translate(e) from e
+        return response.content[0].text, usage_record(response.usage)
+
+    def _stream(self, system, messages, max_tokens):
+        manager = self.client.messages.stream(**self._request(system, messages, max_tokens))
+        try:
+            stream = manager.__enter__()
+        except self._anthropic.APIError as e:
+            raise self._translate(e) from e
+
+        def deltas():
+            try:
+                yield from stream.text_stream
+                handle.usage = usage_record(stream.get_final_message().usage)
+            except self._anthropic.APIError as e:
+                raise self._translate(e) from e
+
+        handle = StreamHandle(deltas(), on_close=lambda: manager.__exit__(None, None, None))
+        return handle
+
+
+# ---------------------------------------------------------------------------
+# OpenAI-compatible HTTP endpoint
+# ---------------------------------------------------------------------------
+
+class OpenAIBackend(LLMBackend):
+    """
+    Any server speaking the OpenAI /chat/completions protocol (vLLM,
+    llama.cpp, Ollama, the llm_stub server, ...). Each thread sends its
+    requests over its own keep-alive http.client connection, re-opened if
+    the server drops it. `base_url` includes the API prefix, e.g.
+    http://localhost:8000/v1.
+    """
+
+    name = "openai"
+
+    def __init__(self, model: str, base_url: str, api_key: str | None = None, retries: int = RETRIES):
+        super().__init__(model, retries)
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid endpoint URL: {base_url!r}")
+        self._https = parts.scheme == "https"
+        self._host = parts.hostname
+        self._port = parts.port
+        self._path = parts.path.rstrip("/") + "/chat/completions"
+        self._headers = {"Content-Type": "application/json"}
+        if api_key:
+            self._headers["Authorization"] = f"Bearer {api_key}"
+        self._local = threading.local()   # per-thread connection
+        self._lock = threading.Lock()
+        self._connections: set[http.client.HTTPConnection] = set()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            conn = self._local.conn = cls(self._host, self._port, timeout=TIMEOUT_S)
+            with self._lock:
+                self._connections.add(conn)
+        return conn
+
+    def _drop_connection(self) -> None:
+        """Close this thread's connection; the next request reconnects."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+            with self._lock:
+                self._connections.discard(conn)
+
+    def close(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def _post(self, body: dict) -> http.client.HTTPResponse:
+        """Send one request; raises _Retryable for transient failures."""
+        payload = json.dumps(body).encode()
+        try:
+            conn = self._connection()
+            conn.request("POST", self._path, body=payload, headers=self._headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            self._drop_connection()   # stale keep-alive connection; the retry reconnects
+            raise _Retryable(e) from e
+        if response.status >= 400:
+            detail = response.read().decode(errors="replace")[:500]
+            error = BackendError(f"{self.name}: HTTP {response.status}: {detail}")
+            if response.status in (408, 409, 429) or response.status >= 500:
+                raise _Retryable(error)
+            raise error
+        return response
+
+    def _request(self, system: str, messages: list[dict], max_tokens: int, stream: bool) -> dict:
+        body = {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "messages": [{"role": "system", "content": system}] + messages,
+        }
+        if stream:
+            body["stream"] = True
+            body["stream_options"] = {"include_usage": True}
+        return body
+
+    @staticmethod
+    def _usage(usage: dict | None) -> dict:
+        if not usage:
+            return empty_usage()
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return {
+            "input": usage.get("prompt_tokens", 0) - cached,
+            "cache_read": cached,
+            "cache_write": 0,
+            "output": usage.get("completion_tokens", 0),
+        }
+
+    def _complete(self, system, messages, max_tokens):
+        response = self._post(self._request(system, messages, max_tokens, stream=False))
+        try:
+            data = json.loads(response.read())
+        except (OSError, http.client.HTTPException) as e:
+            self._drop_connection()
+            raise _Retryable(e) from e
+        return data["choices"][0]["message"]["content"] or "", self._usage(data.get("usage"))
+
+    def _stream(self, system, messages, max_tokens):
+        response = self._post(self._request(system, messages, max_tokens, stream=True))
+
+        def deltas():
+            # Server-sent events: "data: {json}" lines, terminated by "data: [DONE]"
+            try:
+                for raw in response:
+                    line = raw.decode().strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    if event.get("usage"):
+                        handle.usage = self._usage(event["usage"])
+                    for choice in event.get("choices", []):
+                        text = (choice.get("delta") or {}).get("content")
+                        if text:
+                            yield text
+            except (OSError, http.client.HTTPException) as e:
+                self._drop_connection()
+                raise _Retryable(e) from e
+
+        def finish():
+            # Drain what is left so the keep-alive connection can be reused
+            try:
+                response.read()
+            except (OSError, http.client.HTTPException):
+                self._drop_connection()
+
+        handle = StreamHandle(deltas(), on_close=finish)
+        return handle
+
+
+# ---------------------------------------------------------------------------
+# Factory
+# ---------------------------------------------------------------------------
+
+BACKENDS = ("anthropic", "stub", "openai")
+
+
+def make_backend(spec: str, model: str, api_key: str | None = None) -> LLMBackend:
+    """
+    Build a backend from a command-line spec:
+
+        anthropic                  the Anthropic API (ANTHROPIC_API_KEY)
+        stub                       in-process stub echoing the user's message
+        stub:replies.jsonl         in-process stub replaying canned replies
+        openai:http://host:port/v1 an OpenAI-compatible endpoint
+    """
+    kind, _, arg = spec.partition(":")
+    if kind == "anthropic":
+        return AnthropicBackend(model)
+    if kind == "stub":
+        from llm_stub import StubClient
+        client = StubClient.from_file(arg) if arg else StubClient()
+        backend = AnthropicBackend(model, client=client)
+        backend.name = "stub"
+        return backend
+    if kind == "openai":
+        if not arg:
+            raise ValueError("The openai backend needs an endpoint: openai:http://host:port/v1")
+        return OpenAIBackend(model, arg, api_key=api_key)
+    raise ValueError(f"Unknown backend {spec!r}; choose from {', '.join(BACKENDS)}")
@@ -0,0 +1,230 @@
+"""
+Offline stand-ins for the model API.
+
+StubClient answers messages.create / messages.stream with canned replies
+and reports usage the way the API does, including prompt-cache reads and
+writes, so the agent loop can be exercised without network access or API
+spend. Token counts are estimated at four characters per token.
+
+serve() runs the same replies behind a local OpenAI-compatible HTTP
+endpoint (/v1/chat/completions, streaming or not), for load tests that
+should include a real network round-trip:
+
+    python llm_stub.py --port 8765 --replies replies.jsonl
+    python agent.py --backend openai:http://127.0.0.1:8765/v1
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+CHARS_PER_TOKEN = 4
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def _blocks(content) -> list[dict]:
+    """Normalize a system prompt or message content to a list of text blocks."""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return list(content)
+
+
+class StubClient:
+    """
+    Deterministic replacement for anthropic.Anthropic().
+
+    `replies` are returned in order (cycling); without any, the stub echoes
+    the first line of the latest user message. Prompt caching is simulated:
+    every cache_control breakpoint stores the request prefix up to it, and
+    a later breakpoint whose prefix starts with a stored one reports those
+    tokens as cache reads instead of input.
+    """
+
+    def __init__(self, replies: list[str] | None = None):
+        self.replies = list(replies or [])
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._cached_prefixes: set[str] = set()
+        self.messages = SimpleNamespace(create=self._create, stream=self._stream)
+
+    @classmethod
+    def from_file(cls, path: str) -> "StubClient":
+        """Load replies from a JSONL file with one {"reply": "..."} object per line."""
+        with open(path) as f:
+            return cls([json.loads(line)["reply"] for line in f if line.strip()])
+
+    # ------------------------------------------------------------------
+
+    def _next_reply(self, messages: list[dict]) -> str:
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        if self.replies:
+            return self.replies[(call - 1) % len(self.replies)]
+        last = _blocks(messages[-1]["content"])[0]["text"]
+        return f"Stub reply to: {last.splitlines()[0] if last else ''}"
+
+    def _usage(self, system, messages: list[dict], reply: str) -> SimpleNamespace:
+        # Flatten the request into (text, is_breakpoint) blocks in prompt order
+        blocks = [(b["text"], "cache_control" in b) for b in _blocks(system or [])]
+        for message in messages:
+            blocks.extend((b["text"], "cache_control" in b) for b in _blocks(message["content"]))
+
+        # Like the API, a breakpoint also finds entries written at earlier
+        # block boundaries of the same prefix.
+        prefix = hashlib.sha256()
+        total = cached = written = 0
+        boundaries, written_keys = [], []
+        for text, breakpoint in blocks:
+            prefix.update(text.encode())
+            total += _tokens(text)
+            boundaries.append((prefix.hexdigest(), total))
+            if breakpoint:
+                for key, tokens in reversed(boundaries):
+                    if key in self._cached_prefixes:
+                        cached = max(cached, tokens)
+                        break
+                written_keys.append(boundaries[-1][0])
+                written = total - cached
+        self._cached_prefixes.update(written_keys)
+
+        return SimpleNamespace(
+            input_tokens=total - cached - written,
+            cache_read_input_tokens=cached,
+            cache_creation_input_tokens=written,
+            output_tokens=_tokens(reply),
+        )
+
+    def _create(self, model: str, max_tokens: int, messages: list[dict], system=None, **kwargs):
+        reply = self._next_reply(messages)
+        return SimpleNamespace(
+            model=model,
+            content=[SimpleNamespace(type="text", text=reply)],
+            stop_reason="end_turn",
+            usage=self._usage(system, messages, reply),
+        )
+
+    @contextlib.contextmanager
+    def _stream(self, **kwargs):
+        message = self._create(**kwargs)
+        text = message.content[0].text
+        yield SimpleNamespace(
+            # Word-sized deltas, like a real stream
+            text_stream=iter(text[i:i + 8] for i in range(0, len(text), 8)),
+            get_final_message=lambda: message,
+        )
+
+
+# ---------------------------------------------------------------------------
+# OpenAI-compatible HTTP server
+# ---------------------------------------------------------------------------
+
+def _completion_handler(stub: StubClient, token_delay: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, so clients can reuse connections
+        disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data: bytes) -> None:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            if not self.path.endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"no route {self.path}"}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            messages = request["messages"]
+            system = "\n".join(m["content"] for m in messages if m["role"] == "system")
+            chat = [m for m in messages if m["role"] != "system"]
+            reply = stub._next_reply(chat)
+            usage = stub._usage(system, chat, reply)
+            usage = {
+                "prompt_tokens": usage.input_tokens,
+                "completion_tokens": usage.output_tokens,
+                "total_tokens": usage.input_tokens + usage.output_tokens,
+            }
+            model = request.get("model", "stub")
+
+            if not request.get("stream"):
+                self._send_json(200, {
+                    "object": "chat.completion",
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": reply},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+                return
+
+            # Server-sent events over chunked transfer encoding
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(0, len(reply), 8):
+                event = {"object": "chat.completion.chunk", "model": model,
+                         "choices": [{"index": 0, "delta": {"content": reply[i:i + 8]}}]}
+                self._write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+                if token_delay:
+                    time.sleep(token_delay)
+            final = {"object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+            self._write_chunk(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+            self._write_chunk(b"")
+
+    return Handler
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    replies: list[str] | None = None,
+    token_delay: float = 0.0,
+) -> ThreadingHTTPServer:
+    """
+    Create an OpenAI-compatible stub server (call serve_forever() on it).
+
+    `token_delay` seconds are slept between streamed chunks to mimic
+    generation speed. Port 0 picks a free port (see server_address).
+    """
+    server = ThreadingHTTPServer((host, port), _completion_handler(StubClient(replies), token_delay))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--replies", metavar="JSONL", help='Canned replies, one {"reply": "..."} per line')
+    parser.add_argument("--token-delay", type=float, default=0.0, metavar="S",
+                        help="Seconds to wait between streamed chunks")
+    args = parser.parse_args()
+
+    replies = StubClient.from_file(args.replies).replies if args.replies else None
+    server = serve(args.host, args.port, replies, args.token_delay)
+    print(f"Stub LLM server on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,112 @@
+"""
+Command Metrics Registry
+
+In-process registry of per-command timings and resource usage, grouped by
+command verb (show, ray, align, png, ...), with an optional JSONL log of
+every sample for offline analysis.
+"""
+
+import json
+import math
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:   # not available on Windows
+    resource = None
+
+# Upper bounds (seconds) of the wall-time histogram buckets
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, math.inf)
+
+_lock = threading.Lock()
+_by_verb: dict[str, dict] = {}
+_log_path: str | None = None
+
+
+def peak_rss_kb() -> int | None:
+    """Peak resident set size of this process in KiB, or None if unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak   # macOS reports bytes
+
+
+def set_log_path(path: str | None) -> None:
+    """Append every recorded sample to `path` as one JSON line; None disables logging."""
+    global _log_path
+    _log_path = path
+
+
+def record(sample: dict) -> None:
+    """
+    Add one command sample to the registry.
+
+    `sample` must contain "verb" and "wall_s"; "cpu_s", "rss_delta_kb",
+    "atoms" and "output_chars" are aggregated when present.
+    """
+    wall = sample["wall_s"]
+    with _lock:
+        stats = _by_verb.setdefault(sample["verb"], {
+            "count": 0,
+            "wall_total_s": 0.0,
+            "wall_max_s": 0.0,
+            "cpu_total_s": 0.0,
+            "rss_delta_max_kb": 0,
+            "atoms_max": 0,
+            "output_chars_total": 0,
+            "histogram": [0] * len(HISTOGRAM_BUCKETS),
+        })
+        stats["count"] += 1
+        stats["wall_total_s"] += wall
+        stats["wall_max_s"] = max(stats["wall_max_s"], wall)
+        stats["cpu_total_s"] += sample.get("cpu_s") or 0.0
+        stats["rss_delta_max_kb"] = max(stats["rss_delta_max_kb"], sample.get("rss_delta_kb") or 0)
+        stats["atoms_max"] = max(stats["atoms_max"], sample.get("atoms") or 0)
+        stats["output_chars_total"] += sample.get("output_chars") or 0
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if wall <= bound:
+                stats["histogram"][i] += 1
+                break
+
+        if _log_path is not None:
+            with open(_log_path, "a") as f:
+                f.write(json.dumps(sample) + "\n")
+
+
+def summary() -> dict[str, dict]:
+    """
+    Return a copy of the per-verb aggregates.
+
+    Each entry holds count, wall/CPU totals, max wall time, max peak-RSS
+    growth, largest affected selection, total output size and a wall-time
+    histogram whose buckets are given by HISTOGRAM_BUCKETS.
+    """
+    with _lock:
+        return {
+            verb: {**stats, "histogram": list(stats["histogram"])}
+            for verb, stats in _by_verb.items()
+        }
+
+
+def reset() -> None:
+    """Forget all recorded samples."""
+    with _lock:
+        _by_verb.clear()
+
+
+def timer() -> tuple[float, float, int | None]:
+    """Start a measurement; pass the result to elapsed()."""
+    return time.perf_counter(), time.process_time(), peak_rss_kb()
+
+
+def elapsed(start: tuple[float, float, int | None]) -> dict:
+    """Wall time, CPU time and peak-RSS growth since timer() returned `start`."""
+    wall0, cpu0, rss0 = start
+    rss1 = peak_rss_kb()
+    return {
+        "wall_s": time.perf_counter() - wall0,
+        "cpu_s": time.process_time() - cpu0,
+        "rss_delta_kb": rss1 - rss0 if rss0 is not None and rss1 is not None else None,
+    }
@@ -3,106 +3,1241 @@ PyMOL Interface Layer
 
 Wraps pymol2 operations into clean Python functions so the agent layer
 stays free of PyMOL-specific logic.
+
+By default the session lives in this process. After
+start_supervised_session() the public functions are forwarded to a
+PyMOL worker subprocess instead (see pymol_worker), which lets long
+commands be given a time budget and aborted. With start_worker_pool()
+many sessions run side by side; use_session(session_id) picks the one
+the current thread or task talks to.
 """
 
+import atexit
+import contextlib
+import contextvars
+import functools
+import glob
+import hashlib
 import io
+import multiprocessing
 import os
+import re
 import sys
+import time
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
 import pymol2
 
+import metrics
+from pymol_worker import CommandTimeout, PyMOLWorker, PyMOLWorkerPool, WorkerCrashed
+from structure_cache import FORMATS, StructureNotFound, get_structure_cache, is_pdb_id
+from structure_filter import filter_structure, parse_chains, parse_states, structure_format
+from structure_sidecar import dump_object, get_sidecar_cache, restore_object
+
 # ---------------------------------------------------------------------------
 # Singleton session management
 # ---------------------------------------------------------------------------
 
 _pymol: pymol2.PyMOL | None = None
+_worker: PyMOLWorker | None = None   # default supervised session
+_pool: PyMOLWorkerPool | None = None
+# Worker bound by use_session() for the current thread / task
+_bound_worker: contextvars.ContextVar[PyMOLWorker | None] = contextvars.ContextVar(
+    "pymol_bound_worker", default=None,
+)
 
 
 def get_session() -> pymol2.PyMOL:
-    """Return the active PyMOL session, starting one if needed."""
+    """Return the active in-process PyMOL session, starting one if needed."""
     global _pymol
     if _pymol is None:
         _pymol = pymol2.PyMOL()
         _pymol.start()
+        _pymol.cmd.extend("load_remainder", _load_remainder_command)
+        _pymol.cmd.extend("load_many", _load_many_command)
     return _pymol
 
 
+def start_supervised_session() -> None:
+    """
+    Move the session into a supervised worker subprocess.
+
+    From then on the public functions of this module run in the worker,
+    command time budgets (VERB_TIMEOUTS, COMMAND_TIMEOUT) are enforced and
+    a crash inside PyMOL no longer takes this process down.
+    """
+    global _worker
+    if _worker is None:
+        _worker = PyMOLWorker()
+        _worker.start()
+
+
+def start_worker_pool(max_sessions: int | None = None, prestart: int = 0) -> None:
+    """
+    Allow up to `max_sessions` concurrent sessions (default: one per CPU),
+    each in its own worker process; `prestart` workers are launched now.
+    Select a session with use_session().
+    """
+    global _pool
+    if _pool is None:
+        _pool = PyMOLWorkerPool(max_sessions or os.cpu_count() or 1, prestart)
+
+
+@contextlib.contextmanager
+def use_session(session_id: str):
+    """
+    Route this module's functions to the pooled session `session_id` inside
+    the with-block. The binding is per thread / asyncio task, so concurrent
+    users can each drive their own session.
+    """
+    if _pool is None:
+        raise RuntimeError("No worker pool; call start_worker_pool() first")
+    token = _bound_worker.set(_pool.session(session_id))
+    try:
+        yield
+    finally:
+        _bound_worker.reset(token)
+
+
+def end_session(session_id: str) -> None:
+    """Discard a pooled session and stop its worker."""
+    if _pool is not None:
+        _pool.release(session_id)
+
+
+def _active_worker() -> PyMOLWorker | None:
+    return _bound_worker.get() or _worker
+
+
 def close_session() -> None:
-    """Shut down the PyMOL session."""
-    global _pymol
+    """
+    Shut down the PyMOL session: the pooled one bound by use_session() if
+    any, otherwise the default (supervised or in-process) session.
+    """
+    global _pymol, _worker
+    bound = _bound_worker.get()
+    if bound is not None:
+        end_session(bound.session_id)
+        return
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
     if _pymol is not None:
         _pymol.stop()
         _pymol = None
+    invalidate_session_state()
+
+
+def close_worker_pool() -> None:
+    """Stop every pooled session."""
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+@atexit.register
+def _stop_workers() -> None:
+    # Worker processes are not daemons; stop them so interpreter exit does not wait on them
+    global _worker
+    close_worker_pool()
+    if _worker is not None:
+        _worker.stop()
+        _worker = None
+
+
+def _forwarded(read_only: bool = False, sticky: bool = False, budget=None, describe=None, resets: bool = False):
+    """
+    Run the decorated public function in the active worker, if there is one.
+
+    `budget(*args, **kwargs)` returns the call's time budget in seconds and
+    `describe(*args, **kwargs)` names the call in timeout errors. read_only
+    calls are not replayed when the worker's session is rebuilt; sticky
+    ones (configuration) are replayed on every restart. `resets` calls
+    leave an empty session, so the worker drops its checkpoint and journal.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            worker = _active_worker()
+            if worker is None:
+                return func(*args, **kwargs)
+            return worker.call(
+                func.__name__,
+                args,
+                kwargs,
+                timeout=budget(*args, **kwargs) if budget else None,
+                mutates=not read_only,
+                sticky=sticky,
+                resets=resets,
+                label=describe(*args, **kwargs) if describe else func.__name__,
+            )
+        return wrapper
+    return decorate
+
+
+@_forwarded(resets=True)
+def reset_session() -> None:
+    """Clear the session (objects, selections, settings, view) without restarting PyMOL."""
+    get_session().cmd.reinitialize()
+    _partial_loads.clear()
+    invalidate_session_state()
+
+
+def _save_checkpoint(path: str) -> dict:
+    """
+    Worker side: save the whole session so it can be rebuilt after a kill.
+    Returns the state a .pse does not hold (what partially loaded objects
+    left out), to be passed back to _load_checkpoint.
+    """
+    get_session().cmd.save(path)
+    return {"partial_loads": _partial_loads}
+
+
+def _load_checkpoint(path: str, state: dict | None = None) -> None:
+    """Worker side: replace the session with a checkpoint saved by _save_checkpoint."""
+    get_session().cmd.load(path)
+    _partial_loads.clear()
+    if state is not None:
+        _partial_loads.update(state["partial_loads"])
+    invalidate_session_state()
+
+
+# ---------------------------------------------------------------------------
+# Session state cache
+# ---------------------------------------------------------------------------
+
+# Commands that never change the atoms, chains or selection membership of
+# objects that already exist. New objects (distance, align object=...) are
+# picked up anyway because the object list is re-read on every snapshot.
+_STATE_NEUTRAL_VERBS = frozenset({
+    "align", "angle", "as", "bg", "bg_color", "cartoon", "center", "clip",
+    "color", "count_atoms", "deselect", "dihedral", "disable", "distance",
+    "draw", "enable", "fit", "frame", "get", "get_chains", "get_view",
+    "help", "hide", "label", "move", "mplay", "mstop", "orient", "pair_fit",
+    "png", "print", "ray", "rebuild", "recolor", "refresh", "reset", "rms",
+    "rms_cur", "rock", "rotate", "scene", "set", "set_bond", "set_color",
+    "set_view", "show", "show_as", "spectrum", "super", "translate", "turn",
+    "unset", "view", "viewport", "zoom",
+    "util.cba", "util.cbc", "util.cbss", "util.chainbow", "util.rainbow",
+})
+
+# Commands that only (re)define selections.
+_SELECTION_VERBS = frozenset({"select"})
+
+# get_session_snapshot() entries, kept until invalidate_session_state() drops them.
+_object_state_cache: dict[str, dict] = {}
+_selection_state_cache: dict[str, dict] = {}
+
+# Name -> tick of the last command that mentioned it; used to rank entries
+# when the serialized state has to fit a size budget.
+_use_clock = 0
+_name_last_used: dict[str, int] = {}
+
+_NAME_TOKEN_RE = re.compile(r"[A-Za-z0-9_.\-]+")
+
+
+def _command_verbs(cmd_string: str) -> list[str]:
+    """Return the lower-cased verb of every command in a (possibly ;-joined) string."""
+    verbs = []
+    for part in cmd_string.replace("\n", ";").split(";"):
+        part = part.strip()
+        if part:
+            verbs.append(part.replace(",", " ").split()[0].lower())
+    return verbs
+
+
+def _touch_names(text: str) -> None:
+    """Record every name-like token in `text` as just used."""
+    global _use_clock
+    _use_clock += 1
+    for token in _NAME_TOKEN_RE.findall(text):
+        _name_last_used[token] = _use_clock
+
+
+@_forwarded(read_only=True)
+def invalidate_session_state(objects: list[str] | None = None, selections: bool = True) -> None:
+    """
+    Drop cached session-state entries.
+
+    `objects` lists the object names whose atoms or chains may have changed;
+    None invalidates every object. Selection counts are dropped as well
+    unless `selections` is False.
+    """
+    if objects is None:
+        _object_state_cache.clear()
+    else:
+        for obj in objects:
+            _object_state_cache.pop(obj, None)
+    if selections:
+        _selection_state_cache.clear()
+
+
+def _invalidate_for_command(cmd_string: str) -> None:
+    """Invalidate whatever cached state the given command string may have changed."""
+    verbs = [v for v in _command_verbs(cmd_string) if v not in _STATE_NEUTRAL_VERBS]
+    if not verbs:
+        return
+    if all(v in _SELECTION_VERBS for v in verbs):
+        invalidate_session_state(objects=[])
+    else:
+        invalidate_session_state()
 
 
 # ---------------------------------------------------------------------------
 # Core interface functions
 # ---------------------------------------------------------------------------
 
-def load_structure(pdb_id_or_path: str) -> str:
+def _load_file(cmd, path: str, name: str, fmt: str = "") -> None:
+    """
+    cmd.load `path` as a new object `name`, from its pre-parsed sidecar when
+    there is one (see structure_sidecar); large files get a sidecar on
+    their first load. Loading into an existing object (a new state) always
+    parses the file.
+    """
+    sidecars = get_sidecar_cache()
+    if sidecars is None or not sidecars.wants(path) or name in cmd.get_names("all"):
+        cmd.load(path, name, format=fmt)
+        return
+    tag = cmd.get_version()[0]
+    session = sidecars.get(path, tag)
+    if session is not None:
+        restore_object(cmd, session, name)
+        return
+    cmd.load(path, name, format=fmt)
+    if name in cmd.get_names("objects"):
+        sidecars.put(path, tag, dump_object(cmd, name))
+
+
+# Objects loaded in part: name -> {"source", "fmt", "chains", "states", "selection", "dropped"}
+# where "dropped" is the filter_structure() report of what was left out
+_partial_loads: dict[str, dict] = {}
+
+
+def _load_part(cmd, path: str, name: str, fmt: str, chains, states, selection: str | None) -> None:
+    """Load the `chains` / `states` / `selection` part of `path` and record the rest."""
+    fmt = fmt or structure_format(path)
+    text, dropped = filter_structure(path, chains, states, fmt)
+    cmd.load_raw(text, fmt, name)
+    removed = 0
+    if selection:
+        before = cmd.count_atoms(f"%{name}")
+        cmd.remove(f"%{name} and not ({selection})")
+        removed = before - cmd.count_atoms(f"%{name}")
+    _partial_loads.pop(name, None)
+    if dropped["atoms"] or removed:
+        _partial_loads[name] = {
+            "source": path, "fmt": fmt, "chains": parse_chains(chains), "states": parse_states(states),
+            "selection": selection if removed else None, "dropped": dropped,
+        }
+
+
+@_forwarded(budget=lambda *args, **kwargs: VERB_TIMEOUTS.get("load"))
+def load_structure(
+    pdb_id_or_path: str,
+    chains=None,
+    selection: str | None = None,
+    states=None,
+) -> str:
     """
     Load a structure into the session.
 
-    Accepts a PDB ID (fetched from RCSB) or a local file path (.pdb, .cif, etc.).
+    Accepts a PDB ID or a local file path (.pdb, .cif, etc.). Four-character
+    PDB IDs come from the local structure cache (see structure_cache),
+    which fills itself from its mirror or RCSB; other identifiers go to
+    cmd.fetch unless offline mode is on. Large files are reloaded from a
+    pre-parsed sidecar (see structure_sidecar) once seen.
+
+    `chains` ("A+B" or ["A", "B"]) and `states` (model numbers: 1, "1-5")
+    load only those atoms of a PDB or mmCIF file, streaming past the rest
+    (see structure_filter); `selection` then keeps only the atoms it
+    matches. What was left out shows in the session state and can be
+    added later with load_remainder().
     Returns the object name PyMOL assigned to it.
     """
     cmd = get_session().cmd
+    partial = chains is not None or states is not None or bool(selection)
     if os.path.exists(pdb_id_or_path):
         name = os.path.splitext(os.path.basename(pdb_id_or_path))[0]
-        cmd.load(pdb_id_or_path, name)
+        path, fmt = pdb_id_or_path, ""
+    elif is_pdb_id(pdb_id_or_path):
+        name = pdb_id_or_path.lower()
+        path, fmt = get_structure_cache().path(pdb_id_or_path, "cif"), "cif"
     else:
         name = pdb_id_or_path.lower()
+        if partial:
+            raise ValueError(f"{pdb_id_or_path!r} is not a file or PDB ID; only those can be loaded in part")
+        if get_structure_cache().offline:
+            raise StructureNotFound(f"{pdb_id_or_path!r} is not a local file and offline mode is on")
+        path = None
         cmd.fetch(pdb_id_or_path, name)
+    if partial:
+        _load_part(cmd, path, name, fmt, chains, states, selection)
+    else:
+        _partial_loads.pop(name, None)
+        if path is not None:
+            _load_file(cmd, path, name, fmt)
+    invalidate_session_state([name])
+    _touch_names(name)
     return name
 
 
-def get_session_state() -> str:
+def _load_remainder(cmd, name: str, chains=None) -> int:
+    part = _partial_loads.get(name)
+    if part is None or name not in cmd.get_object_list():
+        raise ValueError(f"'{name}' was not loaded in part; nothing to add")
+    wanted = parse_chains(chains)
+    text, _ = filter_structure(part["source"], wanted, part["states"], part["fmt"])
+    tmp = cmd.get_unused_name("_remainder")
+    cmd.load_raw(text, part["fmt"], tmp)
+    try:
+        # Identical identifiers (segi/chain/resi/resn/name/alt) are already loaded
+        cmd.remove(f"%{tmp} and (%{tmp} in %{name})")
+        added = cmd.count_atoms(f"%{tmp}")
+        if added:
+            cmd.create(name, f"%{name} or %{tmp}", 0, 0)
+    finally:
+        cmd.delete(tmp)
+
+    dropped = part["dropped"]
+    if wanted is None:
+        dropped["chains"].clear()
+    else:
+        for chain in wanted:
+            dropped["chains"].pop(chain, None)
+    # Atoms the selection dropped are back once every originally loaded chain is complete
+    if wanted is None or (part["chains"] is not None and set(part["chains"]) <= set(wanted)):
+        part["selection"] = None
+    if not dropped["chains"] and not dropped["states"] and not part["selection"]:
+        del _partial_loads[name]
+    invalidate_session_state([name])
+    _touch_names(name)
+    return added
+
+
+@_forwarded(budget=lambda *args, **kwargs: VERB_TIMEOUTS.get("load"))
+def load_remainder(name: str, chains=None) -> int:
     """
-    Serialize the current PyMOL session into a human-readable string
-    suitable for injection into the LLM context.
+    Add to object `name` the atoms a partial load_structure() left out:
+    those of `chains`, or all of them. Only the loaded models are
+    completed; load other models with load_structure(..., states=...).
+    Returns the number of atoms added. Also available as the PyMOL
+    command `load_remainder name[, chains]`.
+    """
+    return _load_remainder(get_session().cmd, name, chains)
+
+
+def _load_remainder_command(name: str, chains: str | None = None, _self=None) -> None:
+    try:
+        added = _load_remainder(get_session().cmd, name.strip(), chains)
+    except (ValueError, OSError) as e:
+        print(f" Error: {e}")
+        return
+    print(f' load_remainder: added {added} atoms to "{name.strip()}".')
+
+
+# File types load_many() picks up from a directory (optionally gzipped)
+LOAD_MANY_EXTENSIONS = (
+    ".pdb", ".ent", ".cif", ".mmcif", ".bcif", ".pdbqt", ".pqr", ".gro",
+    ".sdf", ".mol", ".mol2", ".xyz",
+)
+# Below this much input, parsing in the current session beats starting a pool
+LOAD_MANY_PARALLEL_MIN_BYTES = 16 * 1024 * 1024
+
+
+def _expand_sources(sources) -> list[str]:
+    """Files named by a directory, glob pattern, path or list of those, in sorted order."""
+    items = [sources] if isinstance(sources, str) else list(sources)
+    paths: list[str] = []
+    for item in items:
+        item = os.path.expanduser(item)
+        if os.path.isdir(item):
+            found = sorted(
+                os.path.join(item, n) for n in os.listdir(item)
+                if n.lower().removesuffix(".gz").endswith(LOAD_MANY_EXTENSIONS)
+            )
+        elif glob.has_magic(item):
+            found = sorted(p for p in glob.glob(item) if os.path.isfile(p))
+        else:
+            found = [item]
+        paths.extend(p for p in found if p not in paths)
+    return paths
+
+
+def _object_name(cmd, path: str, prefix: str, taken: set[str]) -> str:
+    """A legal, unused object name for `path`: prefix + file name without extensions."""
+    stem = os.path.basename(path)
+    if stem.lower().endswith(".gz"):
+        stem = stem[:-3]
+    stem = os.path.splitext(stem)[0]
+    base = cmd.get_legal_name(prefix + stem)
+    name, n = base, 1
+    while name in taken:
+        n += 1
+        name = f"{base}_{n}"
+    taken.add(name)
+    return name
+
+
+def _parse_file(path: str) -> dict:
+    """
+    Pool task: load `path` into this process's own session, check it has
+    atoms and return it as a dump_object() session (also stored as a
+    sidecar when worth one), or the error.
     """
     cmd = get_session().cmd
+    start = time.perf_counter()
+    try:
+        cmd.delete("all")
+        cmd.load(path, "m")
+        atoms = cmd.count_atoms("m")
+        if not atoms:
+            raise ValueError("no atoms loaded")
+        session = dump_object(cmd, "m")
+        sidecars = get_sidecar_cache()
+        if sidecars is not None and sidecars.wants(path):
+            sidecars.put(path, cmd.get_version()[0], session)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}", "parse_s": time.perf_counter() - start}
+    finally:
+        cmd.delete("all")
+    return {"session": session, "atoms": atoms, "parse_s": time.perf_counter() - start}
+
+
+@_forwarded(budget=lambda *args, **kwargs: VERB_TIMEOUTS.get("load_many"))
+def load_many(sources, prefix: str = "", processes: int | None = None) -> list[dict]:
+    """
+    Load every structure file in a directory, glob pattern or list of
+    paths, each as its own object named prefix + file name.
+
+    Files already seen are restored from their sidecars. The rest are
+    parsed and validated (at least one atom) on a pool of `processes`
+    worker processes (default: one per CPU), each with its own headless
+    PyMOL session, when there is enough input to repay starting one;
+    processes=1 parses in the current session. Objects are added in
+    sorted path order whatever order parsing finishes in.
+
+    Returns one record per file, in that order: {"path", "name", "status"
+    ("ok" / "error"), "error", "atoms", "source" ("sidecar" / "parsed"),
+    "parse_s", "merge_s"}. Failed files do not stop the others. If a pool
+    process dies (PyMOL crashing on a file), the files it had not returned
+    yet are reported as errors rather than re-parsed here, where the same
+    file could take the session down; retry them with processes=1.
+    """
+    cmd = get_session().cmd
+    paths = _expand_sources(sources)
+    sidecars = get_sidecar_cache()
+    tag = cmd.get_version()[0]
+    taken = set(cmd.get_names("all"))
+
+    records, to_parse = [], []
+    for path in paths:
+        record = {"path": path, "name": _object_name(cmd, path, prefix, taken), "status": "ok", "error": None,
+                  "atoms": 0, "source": "parsed", "parse_s": 0.0, "merge_s": 0.0}
+        records.append(record)
+        if not os.path.isfile(path):
+            record.update(status="error", error="no such file")
+        elif sidecars is not None and sidecars.wants(path) and (session := sidecars.get(path, tag)) is not None:
+            record.update(source="sidecar", session=session)
+        else:
+            to_parse.append(record)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(to_parse))
+    total_bytes = sum(os.path.getsize(r["path"]) for r in to_parse)
+    if processes > 1 and total_bytes >= LOAD_MANY_PARALLEL_MIN_BYTES:
+        pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        chunksize = max(1, len(to_parse) // (processes * 4))
+        parsed = pool.map(_parse_file, [r["path"] for r in to_parse], chunksize=chunksize)
+    else:
+        pool = parsed = None
+    pool_broken = None
+
+    try:
+        for record in records:
+            if record["status"] == "error":
+                continue
+            start = time.perf_counter()
+            if record["source"] == "sidecar":
+                restore_object(cmd, record.pop("session"), record["name"])
+            elif pool_broken:
+                record.update(status="error", error=pool_broken)
+                continue
+            elif parsed is not None:
+                try:
+                    result = next(parsed)   # map() yields in submission order, i.e. path order
+                except BrokenProcessPool:
+                    pool_broken = "BrokenProcessPool: a parser process died before this file was returned"
+                    record.update(status="error", error=pool_broken)
+                    continue
+                record["parse_s"] = result["parse_s"]
+                if "error" in result:
+                    record.update(status="error", error=result["error"])
+                    continue
+                start = time.perf_counter()
+                restore_object(cmd, result["session"], record["name"])
+            else:
+                try:
+                    _load_file(cmd, record["path"], record["name"])
+                except Exception as e:
+                    record.update(status="error", error=f"{type(e).__name__}: {e}")
+                record["parse_s"] = time.perf_counter() - start
+                start = time.perf_counter()
+            if record["status"] == "ok":
+                if record["name"] in cmd.get_names("objects"):
+                    record["atoms"] = cmd.count_atoms(f"%{record['name']}")
+                if not record["atoms"]:
+                    cmd.delete(record["name"])
+                    record.update(status="error", error="ValueError: no atoms loaded")
+            record["merge_s"] = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        # Objects merged before a failure are in the session too
+        invalidate_session_state([r["name"] for r in records])
+
+    for record in records:
+        if record["status"] == "ok":
+            _touch_names(record["name"])
+    return records
+
+
+def _load_many_command(sources: str, prefix: str = "", _self=None) -> None:
+    start = time.perf_counter()
+    records = load_many(sources.strip(), prefix.strip())
+    failed = [r for r in records if r["status"] == "error"]
+    print(f" load_many: loaded {len(records) - len(failed)} of {len(records)} file(s) "
+          f"in {time.perf_counter() - start:.1f} s.")
+    for r in failed:
+        print(f" Error: {r['path']}: {r['error']}")
+
+
+def _format_ranges(numbers: list[int]) -> str:
+    """[1, 2, 3, 7] -> "1-3, 7"."""
+    spans = []
+    for n in numbers:
+        if spans and n == spans[-1][1] + 1:
+            spans[-1][1] = n
+        else:
+            spans.append([n, n])
+    return ", ".join(str(a) if a == b else f"{a}-{b}" for a, b in spans)
+
+
+def _describe_remainder(part: dict) -> str:
+    dropped = part["dropped"]
+    bits = []
+    if dropped["chains"]:
+        bits.append("chains " + ", ".join(
+            f"{chain or '(blank)'} ({atoms} atoms)" for chain, atoms in sorted(dropped["chains"].items())
+        ))
+    if dropped["states"]:
+        bits.append("models " + _format_ranges(dropped["states"]))
+    if part["selection"]:
+        bits.append(f"atoms outside ({part['selection']})")
+    return "; ".join(bits)
+
+
+# Residue names used to split atoms into polymer / solvent / ligand in the
+# single-pass collector; anything else counts as ligand (incl. ions).
+_POLYMER_RESN = frozenset({
+    "ALA", "ARG", "ASN", "ASP", "CYS", "GLN", "GLU", "GLY", "HIS", "ILE",
+    "LEU", "LYS", "MET", "PHE", "PRO", "SER", "THR", "TRP", "TYR", "VAL",
+    "SEC", "PYL", "MSE", "HID", "HIE", "HIP", "HSD", "HSE", "HSP", "CYX", "ASX", "GLX", "UNK",
+    "A", "C", "G", "U", "I", "DA", "DC", "DG", "DT", "DU", "DI", "N",
+})
+_SOLVENT_RESN = frozenset({"HOH", "WAT", "H2O", "DOD", "D2O", "TIP", "TIP3", "SOL"})
+
+SESSION_STATE_COLLECTORS = ("counts", "iterate")
+_state_cache_collector = "counts"
+
+
+def _collect_counts(cmd, objects: list[str]) -> dict[str, dict]:
+    """Per-object count_atoms/get_chains calls."""
+    return {
+        obj: {"atoms": cmd.count_atoms(obj), "chains": cmd.get_chains(obj)}
+        for obj in objects
+    }
+
+
+def _collect_single_pass(cmd, objects: list[str], all_objects: bool) -> dict[str, dict]:
+    """
+    Walk every atom of `objects` with one iterate and aggregate per object:
+    atom and residue counts, chains and a polymer/ligand/solvent breakdown.
+    """
+    space = {"atoms": []}
+    selection = "all" if all_objects else " or ".join(f"%{obj}" for obj in objects)
+    cmd.iterate(selection, "atoms.append((model, segi, chain, resi, resn))", space=space)
+
+    summary = {
+        obj: {"chains": set(), "residues": set(), "polymer": 0, "solvent": 0, "ligands": {}}
+        for obj in objects
+    }
+    atom_counts = dict.fromkeys(objects, 0)
+    for model, segi, chain, resi, resn in space["atoms"]:
+        info = summary.get(model)
+        if info is None:
+            continue
+        atom_counts[model] += 1
+        info["chains"].add(chain)
+        info["residues"].add((segi, chain, resi))
+        if resn in _POLYMER_RESN:
+            info["polymer"] += 1
+        elif resn in _SOLVENT_RESN:
+            info["solvent"] += 1
+        else:
+            info["ligands"][resn] = info["ligands"].get(resn, 0) + 1
+
+    return {
+        obj: {
+            "atoms": atom_counts[obj],
+            "chains": sorted(info["chains"]),
+            "residues": len(info["residues"]),
+            "polymer": info["polymer"],
+            "solvent": info["solvent"],
+            "ligand": sum(info["ligands"].values()),
+            "ligand_resn": sorted(info["ligands"]),
+        }
+        for obj, info in summary.items()
+    }
+
+
+@_forwarded(read_only=True)
+def get_session_snapshot(collector: str = "counts") -> dict:
+    """
+    Return a structured view of the current session:
+
+        {"objects": {name: {"atoms": int, "chains": [str, ...], ...}},
+         "selections": {name: {"atoms": int, ...}}}
+
+    collector="counts" issues count_atoms/get_chains per object and
+    selection. collector="iterate" walks all stale objects in a single
+    iterate and additionally reports residue counts, a polymer / ligand /
+    solvent atom breakdown and ligand residue names per object, plus the
+    objects each selection touches.
+
+    Entries are cached between calls and only recomputed after a command
+    that may have changed them (see invalidate_session_state).
+    """
+    global _state_cache_collector
+    if collector not in SESSION_STATE_COLLECTORS:
+        raise ValueError(f"Unknown collector '{collector}'. Available: {list(SESSION_STATE_COLLECTORS)}")
+    if collector != _state_cache_collector:
+        invalidate_session_state()
+        _state_cache_collector = collector
+
+    cmd = get_session().cmd
 
     objects = cmd.get_object_list()
     selections = [n for n in cmd.get_names("selections")]
 
+    stale = [obj for obj in objects if obj not in _object_state_cache]
+    if stale:
+        if collector == "iterate":
+            _object_state_cache.update(_collect_single_pass(cmd, stale, len(stale) == len(objects)))
+        else:
+            _object_state_cache.update(_collect_counts(cmd, stale))
+
+    for sel in selections:
+        if sel in _selection_state_cache:
+            continue
+        if collector == "iterate":
+            members = cmd.index(sel)
+            _selection_state_cache[sel] = {
+                "atoms": len(members),
+                "objects": sorted({model for model, _ in members}),
+            }
+        else:
+            _selection_state_cache[sel] = {"atoms": cmd.count_atoms(sel)}
+
+    # Forget anything that was deleted or renamed since the last snapshot
+    for name in set(_object_state_cache) - set(objects):
+        del _object_state_cache[name]
+    for name in set(_selection_state_cache) - set(selections):
+        del _selection_state_cache[name]
+    for name in set(_name_last_used) - set(objects) - set(selections):
+        del _name_last_used[name]
+
+    snapshot = {
+        "objects": {obj: dict(_object_state_cache[obj]) for obj in objects},
+        "selections": {sel: dict(_selection_state_cache[sel]) for sel in selections},
+    }
+    for obj, part in _partial_loads.items():
+        if obj in snapshot["objects"]:
+            snapshot["objects"][obj]["unloaded"] = _describe_remainder(part)
+    return snapshot
+
+
+def _format_object(obj: str, info: dict) -> str:
+    text = f"{obj}: {info['atoms']} atoms"
+    if "residues" in info:
+        text += f", {info['residues']} residues"
+    text += f", chains: {', '.join(info['chains']) or 'none'}"
+    if "polymer" in info:
+        text += f"; polymer {info['polymer']}, ligand {info['ligand']}, solvent {info['solvent']} atoms"
+        if info["ligand_resn"]:
+            text += f" (ligands: {', '.join(info['ligand_resn'])})"
+    if "unloaded" in info:
+        text += f"; not loaded: {info['unloaded']}"
+    return text
+
+
+def _format_selection(sel: str, info: dict) -> str:
+    text = f"{sel}: {info['atoms']} atoms"
+    if info.get("objects"):
+        text += f" in {', '.join(info['objects'])}"
+    return text
+
+
+def _name_pattern(name: str) -> str:
+    """Collapse digit runs so model_001 and model_002 share the pattern model_*."""
+    return re.sub(r"\d+", "*", name)
+
+
+# Room kept for the section headers, the two catch-all summary lines and
+# the final elision note (the catch-all lines list at most this many
+# characters of names), plus a minimum for per-pattern summary lines.
+_STATE_RESERVED_CHARS = 400
+_CATCH_ALL_NAMES_CHARS = 80
+_PATTERN_LINES_CHARS = 200
+
+
+def _collapse_elided(names: list[str], noun: str, budget: int) -> list[str]:
+    """
+    Summarize elided entries in at most `budget` characters plus one
+    catch-all line: names sharing a pattern get a line per pattern, largest
+    groups first, while they fit; everything else is counted in the last line.
+    """
+    groups: dict[str, list[str]] = {}
+    for name in names:
+        groups.setdefault(_name_pattern(name), []).append(name)
+
+    lines, rest = [], []
+    for pattern, members in sorted(groups.items(), key=lambda group: -len(group[1])):
+        line = f"  - ... {len(members)} more {noun}s matching {pattern}"
+        if len(members) > 1 and len(line) + 1 <= budget:
+            lines.append(line)
+            budget -= len(line) + 1
+        else:
+            rest.extend(members)
+    if rest:
+        shown = ", ".join(rest[:5]) + (", ..." if len(rest) > 5 else "")
+        if len(shown) > _CATCH_ALL_NAMES_CHARS:
+            shown = shown[:_CATCH_ALL_NAMES_CHARS - 3] + "..."
+        plural = "s" if len(rest) > 1 else ""
+        lines.append(f"  - ... {len(rest)} more {noun}{plural} ({shown})")
+    return lines
+
+
+@_forwarded(read_only=True)
+def format_session_state(snapshot: dict, max_chars: int | None = None) -> str:
+    """
+    Render a get_session_snapshot() result as the text sent to the LLM.
+
+    With `max_chars`, entries are ranked by how recently a command used
+    them and then by atom count; whatever does not fit is collapsed into
+    per-pattern summary lines ("312 more objects matching model_*"), as
+    many as the budget allows, then one catch-all line, and a final line
+    reports how much was elided. The result never exceeds `max_chars`
+    (beyond a floor of a few hundred characters). Kept entries stay in
+    session order.
+    """
+    objects, selections = snapshot["objects"], snapshot["selections"]
+
+    object_lines = {obj: f"  - {_format_object(obj, info)}" for obj, info in objects.items()}
+    selection_lines = {sel: f"  - {_format_selection(sel, info)}" for sel, info in selections.items()}
+
+    kept_objects, kept_selections = set(objects), set(selections)
+    if max_chars is not None:
+        ranked = sorted(
+            [("object", name, info) for name, info in objects.items()]
+            + [("selection", name, info) for name, info in selections.items()],
+            key=lambda entry: (_name_last_used.get(entry[1], 0), entry[2]["atoms"]),
+            reverse=True,
+        )
+        kept_objects, kept_selections = set(), set()
+        budget = max_chars - _STATE_RESERVED_CHARS - _PATTERN_LINES_CHARS
+        for kind, name, _ in ranked:
+            line = object_lines[name] if kind == "object" else selection_lines[name]
+            if len(line) + 1 > budget:
+                break
+            budget -= len(line) + 1
+            (kept_objects if kind == "object" else kept_selections).add(name)
+        budget += _PATTERN_LINES_CHARS   # what is left goes to the summary lines
+
     lines = []
 
     if objects:
         lines.append("Loaded objects:")
-        for obj in objects:
-            n_atoms = cmd.count_atoms(obj)
-            chains = cmd.get_chains(obj)
-            lines.append(f"  - {obj}: {n_atoms} atoms, chains: {', '.join(chains) or 'none'}")
+        lines.extend(line for obj, line in object_lines.items() if obj in kept_objects)
+        elided = [o for o in objects if o not in kept_objects]
+        if elided:
+            summary = _collapse_elided(elided, "object", budget)
+            budget -= sum(len(line) + 1 for line in summary[:-1])
+            lines.extend(summary)
     else:
         lines.append("No objects loaded.")
 
     if selections:
         lines.append("Active selections:")
-        for sel in selections:
-            n_atoms = cmd.count_atoms(sel)
-            lines.append(f"  - {sel}: {n_atoms} atoms")
+        lines.extend(line for sel, line in selection_lines.items() if sel in kept_selections)
+        elided = [s for s in selections if s not in kept_selections]
+        if elided:
+            lines.extend(_collapse_elided(elided, "selection", budget))
+
+    elided_objects = len(objects) - len(kept_objects)
+    elided_selections = len(selections) - len(kept_selections)
+    if elided_objects or elided_selections:
+        lines.append(
+            f"[Elided {elided_objects} of {len(objects)} objects and "
+            f"{elided_selections} of {len(selections)} selections to fit "
+            f"a {max_chars}-character budget]"
+        )
 
     return "\n".join(lines)
 
 
-def execute_command(cmd_string: str) -> str:
+def format_session_state_delta(previous: dict, current: dict) -> str:
+    """
+    Describe how the session changed between two snapshots.
+
+    Lines start with + (added), - (removed) or ~ (changed). Returns
+    "No changes." when the snapshots are identical. The result is not
+    budgeted: callers send a budgeted full state instead when it is too
+    long (see agent.build_state_context).
+    """
+    lines = []
+
+    prev_objects, objects = previous["objects"], current["objects"]
+    for obj, info in objects.items():
+        if obj not in prev_objects:
+            lines.append(f"  + object {_format_object(obj, info)}")
+        elif info != prev_objects[obj]:
+            lines.append(f"  ~ object {_format_object(obj, info)} (was {prev_objects[obj]['atoms']} atoms)")
+    for obj in prev_objects:
+        if obj not in objects:
+            lines.append(f"  - object {obj}")
+
+    prev_selections, selections = previous["selections"], current["selections"]
+    for sel, info in selections.items():
+        if sel not in prev_selections:
+            lines.append(f"  + selection {_format_selection(sel, info)}")
+        elif info != prev_selections[sel]:
+            lines.append(f"  ~ selection {_format_selection(sel, info)} (was {prev_selections[sel]['atoms']} atoms)")
+    for sel in prev_selections:
+        if sel not in selections:
+            lines.append(f"  - selection {sel}")
+
+    return "\n".join(lines) if lines else "No changes."
+
+
+@_forwarded(read_only=True)
+def get_session_state(collector: str = "counts", max_chars: int | None = None) -> str:
+    """
+    Serialize the current PyMOL session into a human-readable string
+    suitable for injection into the LLM context.
+
+    See get_session_snapshot for the available collectors and
+    format_session_state for `max_chars`.
+    """
+    return format_session_state(get_session_snapshot(collector), max_chars)
+
+
+# Time budgets in seconds, enforced when the session runs on a supervised
+# worker. VERB_TIMEOUTS covers the commands that can run away on large
+# structures; COMMAND_TIMEOUT applies to every other verb (None = no limit).
+COMMAND_TIMEOUT: float | None = None
+VERB_TIMEOUTS: dict[str, float] = {
+    "align": 120.0, "cealign": 300.0, "fetch": 120.0, "h_add": 60.0,
+    "load": 300.0, "load_many": 1800.0, "mpng": 1800.0, "png": 300.0, "ray": 300.0,
+    "save": 300.0, "show": 120.0, "show_as": 120.0, "super": 120.0,
+}
+
+
+def command_budget(cmd_string: str) -> float | None:
+    """Time budget for a command string: the sum over its verbs, or None if unlimited."""
+    budgets = [VERB_TIMEOUTS.get(verb, COMMAND_TIMEOUT) for verb in _command_verbs(cmd_string)]
+    budgets = [b for b in budgets if b is not None]
+    return sum(budgets) if budgets else None
+
+
+# Lines PyMOL prints when a command fails ("Error: ...", "Selector-Error: ...",
+# "SyntaxError: ...", Python tracebacks).
+_ERROR_LINE_RE = re.compile(r"^\s*(?:[\w-]*Error\b|Traceback)", re.MULTILINE)
+
+# Commands that draw the scene and therefore need updates switched back on.
+_RENDER_VERBS = frozenset({"draw", "mpng", "png", "ray"})
+
+
+# Position of the selection argument for verbs whose affected atoms are
+# worth recording in the command metrics.
+_SELECTION_ARG = {
+    "align": 0, "cartoon": 1, "center": 0, "color": 1, "create": 1,
+    "extract": 1, "h_add": 0, "hide": 1, "label": 0, "orient": 0,
+    "remove": 0, "select": 1, "show": 1, "show_as": 1, "spectrum": 2,
+    "super": 0, "zoom": 0,
+}
+
+
+def _affected_atoms(cmd, cmd_string: str, verb: str) -> int | None:
+    """Atom count of the command's selection argument, when it can be parsed."""
+    if verb not in _SELECTION_ARG or ";" in cmd_string or "\n" in cmd_string:
+        return None
+    parts = cmd_string.split(None, 1)
+    args = [a.strip() for a in parts[1].split(",")] if len(parts) > 1 else []
+    index = _SELECTION_ARG[verb]
+    if index >= len(args) or not args[index] or "=" in args[index]:
+        return None
+    try:
+        return cmd.count_atoms(args[index])
+    except Exception:
+        return None
+
+
+_FETCH_KEYWORDS = {"name", "state", "type"}
+
+
+def _fetch_via_cache(cmd, cmd_string: str) -> bool:
+    """
+    Serve a plain `fetch <ids>[, name[, state]][, type=cif|pdb]` from the
+    structure cache. Returns False, having done nothing, for anything else
+    (other keyword arguments, non-PDB codes), which then goes to cmd.fetch.
+    """
+    _, _, args = cmd_string.strip().partition(" ")
+    positional, options = [], {}
+    for part in filter(None, (p.strip() for p in args.split(","))):
+        if "=" in part:
+            key, _, value = part.partition("=")
+            options[key.strip()] = value.strip()
+        else:
+            positional.append(part)
+    if not positional or set(options) - _FETCH_KEYWORDS or len(positional) > 3:
+        return False
+    codes = positional[0].split()
+    name = options.get("name", positional[1] if len(positional) > 1 else "")
+    state = options.get("state", positional[2] if len(positional) > 2 else "0")
+    fmt = options.get("type", "cif")
+    if not codes or not all(is_pdb_id(c) for c in codes) or fmt not in FORMATS:
+        return False
+    if (name and len(codes) > 1) or not state.lstrip("-").isdigit():
+        return False
+
+    for code in codes:
+        try:
+            path = get_structure_cache().path(code, fmt)
+        except (StructureNotFound, OSError) as exc:
+            print(f" Error-fetch: unable to load '{code}': {exc}")
+            continue
+        if int(state) == 0:
+            _load_file(cmd, path, name or code.lower(), fmt)
+        else:
+            cmd.load(path, name or code.lower(), int(state), format=fmt)
+        print(f' Fetched {code} from the local structure cache as "{name or code.lower()}".')
+    return True
+
+
+def _run_captured(cmd_string: str) -> str:
+    """
+    Run one command string through cmd.do and return what it printed.
+
+    Records wall/CPU time, peak-RSS growth, affected atom count and output
+    size in the metrics registry under the command's verb.
+    """
+    cmd = get_session().cmd
+    verbs = _command_verbs(cmd_string)
+    verb = verbs[0] if len(verbs) == 1 else "compound"
+    atoms = _affected_atoms(cmd, cmd_string, verb)
+
+    start = metrics.timer()
+    old_stdout = sys.stdout
+    sys.stdout = buf = io.StringIO()
+    try:
+        if verb != "fetch" or not _fetch_via_cache(cmd, cmd_string):
+            cmd.do(cmd_string)
+    finally:
+        sys.stdout = old_stdout
+        _invalidate_for_command(cmd_string)
+        _touch_names(cmd_string)
+
+    output = buf.getvalue().strip()
+    metrics.record({
+        "verb": verb,
+        "command": cmd_string,
+        "timestamp": time.time(),
+        **metrics.elapsed(start),
+        "atoms": atoms,
+        "output_chars": len(output),
+    })
+    return output
+
+
+@_forwarded(read_only=True)
+def get_command_metrics() -> dict[str, dict]:
+    """Per-verb timing and resource aggregates for every command run so far."""
+    return metrics.summary()
+
+
+@_forwarded(sticky=True)
+def set_metrics_log(path: str | None) -> None:
+    """Append one JSON line per executed command to `path` (None to stop)."""
+    metrics.set_log_path(path)
+
+
+@_forwarded(
+    budget=lambda cmd_string, timeout=None: timeout if timeout is not None else command_budget(cmd_string),
+    describe=lambda cmd_string, timeout=None: cmd_string,
+)
+def execute_command(cmd_string: str, timeout: float | None = None) -> str:
     """
     Execute an arbitrary PyMOL command string and return any captured output.
 
     Text that PyMOL prints to stdout (e.g. RMSD values) is captured and returned.
+    On a supervised session the command gets `timeout` seconds (default: its
+    verb budget, see command_budget); on overrun it is aborted, the session
+    restored to its state before the command and CommandTimeout raised.
     """
     cmd_string = cmd_string.strip()
     if not cmd_string:
         return ""
 
-    old_stdout = sys.stdout
-    sys.stdout = buf = io.StringIO()
+    return _run_captured(cmd_string)
+
+
+@_forwarded()
+def _batch_begin() -> dict:
+    """Suspend scene updates and defer builds; returns the settings to restore."""
+    cmd = get_session().cmd
+    saved = {name: cmd.get_setting_int(name) for name in ("suspend_updates", "defer_builds_mode")}
+    cmd.set("defer_builds_mode", max(saved["defer_builds_mode"], 1))
+    cmd.set("suspend_updates", 1)
+    return saved
+
+
+@_forwarded()
+def _batch_end(saved: dict) -> None:
+    cmd = get_session().cmd
+    cmd.set("suspend_updates", saved["suspend_updates"])
+    cmd.set("defer_builds_mode", saved["defer_builds_mode"])
+
+
+@_forwarded(
+    budget=lambda cmd_string, saved: command_budget(cmd_string),
+    describe=lambda cmd_string, saved: cmd_string,
+)
+def _batch_step(cmd_string: str, saved: dict) -> dict:
+    """Run one command of a batch; render commands get scene updates back."""
+    cmd = get_session().cmd
+    rendering = not _RENDER_VERBS.isdisjoint(_command_verbs(cmd_string))
+    if rendering:
+        cmd.set("suspend_updates", saved["suspend_updates"])
     try:
-        get_session().cmd.do(cmd_string)
+        output = _run_captured(cmd_string)
+        match = _ERROR_LINE_RE.search(output)
+        error = output[match.start():].strip() if match else None
+    except Exception as e:
+        output, error = "", str(e)
     finally:
-        sys.stdout = old_stdout
+        if rendering:
+            cmd.set("suspend_updates", 1)
+    return {"command": cmd_string, "output": output, "error": error}
+
 
-    return buf.getvalue().strip()
+def execute_batch(commands: Iterable[str], stop_on_error: bool = False) -> list[dict]:
+    """
+    Execute several PyMOL commands as one unit.
+
+    Scene updates are suspended and representation builds deferred for the
+    whole batch, so PyMOL redraws once at the end instead of after every
+    command (render commands such as png/ray still see an up-to-date scene).
+    Output is captured per command, and each command keeps its own time
+    budget on a supervised session. `commands` is consumed lazily, so it
+    can be fed while an LLM reply is still streaming in.
+
+    Returns one {"command", "output", "error"} dict per command that ran;
+    "error" holds the error text PyMOL reported (or the timeout/crash
+    message), or None on success. With stop_on_error, commands after the
+    first failure are not run.
+    """
+    results = []
+    saved = _batch_begin()
+    try:
+        for cmd_string in commands:
+            cmd_string = cmd_string.strip()
+            if not cmd_string:
+                continue
+            try:
+                result = _batch_step(cmd_string, saved)
+            except (CommandTimeout, WorkerCrashed) as e:
+                result = {"command": cmd_string, "output": "", "error": str(e)}
+            results.append(result)
+            if result["error"] and stop_on_error:
+                break
+    finally:
+        _batch_end(saved)
+
+    return results
+
+
+# Commands simple and safe enough to run straight from the user's input,
+# without the model, and the kind of each positional argument (trailing
+# "?" = optional).
+DIRECT_COMMANDS: dict[str, tuple[str, ...]] = {
+    "bg_color": ("color",), "center": ("sel?",), "color": ("color", "sel?"),
+    "count_atoms": ("sel?",), "disable": ("sel?",), "enable": ("sel?",),
+    "get_chains": ("sel?",), "hide": ("rep?", "sel?"), "orient": ("sel?",),
+    "remove": ("sel",), "reset": (), "set": ("setting", "value", "sel?"),
+    "show": ("rep?", "sel?"), "show_as": ("rep", "sel?"), "as": ("rep", "sel?"),
+    "turn": ("axis", "number"), "util.cbc": ("sel?",), "util.chainbow": ("sel?",),
+    "zoom": ("sel?", "number?"),
+}
+
+
+def _direct_arg_ok(cmd, kind: str, value: str) -> bool:
+    if kind == "rep":
+        return value in cmd.repres_sc.keywords   # exact: interpret() accepts prefixes
+    if kind == "color":
+        return cmd.get_color_index(value) != -1
+    if kind == "setting":
+        return value in cmd.setting.index_dict
+    if kind == "axis":
+        return value in ("x", "y", "z")
+    if kind == "number":
+        try:
+            float(value)
+        except ValueError:
+            return False
+        return True
+    if kind == "sel":
+        try:
+            cmd.count_atoms(value)
+        except Exception:
+            return False
+        return True
+    return bool(value)
+
+
+@_forwarded(read_only=True)
+def is_direct_command(cmd_string: str) -> bool:
+    """
+    True if `cmd_string` is a single DIRECT_COMMANDS command whose arguments
+    are all valid in the current session: representation and color names
+    exist, settings are known and selections parse. Nothing is executed.
+    """
+    if ";" in cmd_string or "\n" in cmd_string or "=" in cmd_string:
+        return False
+    parts = cmd_string.strip().split(None, 1)
+    if not parts or parts[0] not in DIRECT_COMMANDS:
+        return False
+    kinds = DIRECT_COMMANDS[parts[0]]
+    args = [a.strip() for a in parts[1].split(",")] if len(parts) > 1 else []
+    required = sum(1 for kind in kinds if not kind.endswith("?"))
+    if not required <= len(args) <= len(kinds):
+        return False
+    cmd = get_session().cmd
+    return all(_direct_arg_ok(cmd, kind.rstrip("?"), arg) for kind, arg in zip(kinds, args))
 
 
 def capture_output(pymol_cmd_string: str) -> str:
@@ -115,6 +1250,7 @@ def capture_output(pymol_cmd_string: str) -> str:
     return execute_command(pymol_cmd_string)
 
 
+@_forwarded(budget=lambda *args, **kwargs: VERB_TIMEOUTS.get("png"))
 def render_image(
     filename: str,
     width: int = 1200,
@@ -136,6 +1272,7 @@ def render_image(
 # Publication figure presets (Phase 3)
 # ---------------------------------------------------------------------------
 
+@_forwarded()
 def preset_journal_standard() -> None:
     """White background, ray tracing on, antialias, suitable for most journals."""
     cmd = get_session().cmd
@@ -147,6 +1284,7 @@ def preset_journal_standard() -> None:
     cmd.set("ray_trace_fog", 0)
 
 
+@_forwarded()
 def preset_presentation() -> None:
     """Black background, ambient lighting, wider line widths for slides."""
     cmd = get_session().cmd
@@ -159,6 +1297,7 @@ def preset_presentation() -> None:
     cmd.set("stick_radius", 0.25)
 
 
+@_forwarded()
 def preset_colorblind_safe() -> None:
     """
     Apply a colorblind-accessible color scheme (Wong palette) to all chains.
@@ -191,6 +1330,7 @@ PRESETS = {
 }
 
 
+@_forwarded()
 def apply_preset(name: str) -> None:
     """Apply a named publication preset. Raises KeyError for unknown names."""
     if name not in PRESETS:
@@ -198,10 +1338,96 @@ def apply_preset(name: str) -> None:
     PRESETS[name]()
 
 
+# ---------------------------------------------------------------------------
+# Bulk per-residue property writeback
+# ---------------------------------------------------------------------------
+
+@_forwarded()
+def set_property_bulk(
+    obj: str,
+    values_by_residue_key: dict,
+    field: str = "b",
+) -> int:
+    """
+    Write per-residue values into an atom property of `obj` in one pass.
+
+    Keys may be residue numbers (10), resi strings ("52A") or
+    (chain, resi) tuples; a (chain, resi) match takes precedence over a
+    bare resi match. Every atom of a matched residue receives the value,
+    atoms of unmatched residues keep their current one.
+    Returns the number of atoms visited.
+    """
+    if not field.isidentifier():
+        raise ValueError(f"Invalid atom property name: {field!r}")
+
+    lookup = {}
+    for key, val in values_by_residue_key.items():
+        if isinstance(key, tuple):
+            chain, resi = key
+            lookup[(chain, str(resi))] = val
+        else:
+            lookup[str(key)] = val
+
+    cmd = get_session().cmd
+    if field not in ("b", "q", "x", "y", "z"):
+        invalidate_session_state([obj], selections=False)
+
+    expression = f"{field} = lookup.get((chain, resi), lookup.get(resi, {field}))"
+    if field in ("x", "y", "z"):
+        # Coordinates are per-state; write the current state only.
+        return cmd.alter_state(-1, obj, expression, space={"lookup": lookup})
+    return cmd.alter(obj, expression, space={"lookup": lookup})
+
+
 # ---------------------------------------------------------------------------
 # Per-residue RMSD visualization (Phase 3)
 # ---------------------------------------------------------------------------
 
+def _ca_table(cmd, obj: str, state: int = -1) -> tuple[list[tuple[str, str, int]], np.ndarray]:
+    """
+    Pull the CA atoms of `obj` in `state` in one pass.
+
+    Returns a list of (chain, resi, resv) keys and an (N, 3) coordinate
+    array in the same atom order. Only atoms with coordinates in `state`
+    are listed, so states of one object may have different tables.
+    """
+    selection = f"({obj}) and name CA"
+    space = {"keys": []}
+    cmd.iterate_state(state, selection, "keys.append((chain, resi, resv))", space=space)
+    coords = cmd.get_coords(selection, state=state)
+    if coords is None or len(coords) != len(space["keys"]):
+        return [], np.empty((0, 3))
+    return space["keys"], coords
+
+
+def _match_residues(
+    mobile_keys: list[tuple[str, str, int]],
+    target_keys: list[tuple[str, str, int]],
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pair up CA rows of two tables by (chain, resi).
+
+    Returns index arrays into the mobile and target tables. When a residue
+    has alternate CA positions only the first one is used.
+    """
+    target_index: dict[tuple[str, str], int] = {}
+    for i, (chain, resi, _) in enumerate(target_keys):
+        target_index.setdefault((chain, resi), i)
+
+    seen: set[tuple[str, str]] = set()
+    mobile_rows, target_rows = [], []
+    for i, (chain, resi, _) in enumerate(mobile_keys):
+        key = (chain, resi)
+        if key in seen or key not in target_index:
+            continue
+        seen.add(key)
+        mobile_rows.append(i)
+        target_rows.append(target_index[key])
+
+    return np.asarray(mobile_rows, dtype=np.intp), np.asarray(target_rows, dtype=np.intp)
+
+
+@_forwarded()
 def per_residue_rmsd(mobile: str, target: str) -> dict[int, float]:
     """
     Calculate per-residue RMSD between two aligned objects.
@@ -212,49 +1438,132 @@ def per_residue_rmsd(mobile: str, target: str) -> dict[int, float]:
     """
     cmd = get_session().cmd
 
-    # Collect CA atoms from mobile
-    space = {"residues": {}}
-    cmd.iterate(
-        f"{mobile} and name CA",
-        "residues[resi] = (model, chain, resi, resn)",
-        space=space,
-    )
-
-    rmsd_by_resi: dict[int, float] = {}
-
-    for resi, (model, chain, resi_str, resn) in space["residues"].items():
-        mobile_sel = f"{mobile} and chain {chain} and resi {resi_str} and name CA"
-        target_sel = f"{target} and chain {chain} and resi {resi_str} and name CA"
+    # Pull both CA tables once and compare every matched pair in one shot;
+    # the RMSD of a single CA pair is simply their distance.
+    mobile_keys, mobile_xyz = _ca_table(cmd, mobile)
+    target_keys, target_xyz = _ca_table(cmd, target)
+    mobile_rows, target_rows = _match_residues(mobile_keys, target_keys)
 
-        # rms_cur returns RMSD as float; returns -1 if selection empty
-        try:
-            val = cmd.rms_cur(mobile_sel, target_sel, matchmaker=4)
-        except Exception:
-            val = 0.0
+    deviations = np.linalg.norm(mobile_xyz[mobile_rows] - target_xyz[target_rows], axis=1)
 
-        if val >= 0:
-            rmsd_by_resi[int(resi_str)] = val
+    rmsd_by_resi: dict[int, float] = {}
+    for row, val in zip(mobile_rows.tolist(), deviations.tolist()):
+        rmsd_by_resi[mobile_keys[row][2]] = val
 
     if not rmsd_by_resi:
         return rmsd_by_resi
 
     # Store RMSD values in B-factor column for coloring
     max_rmsd = max(rmsd_by_resi.values())
-
-    def _set_bfactor(resi_str, val, mobile=mobile):
-        cmd.alter(
-            f"{mobile} and resi {resi_str}",
-            f"b = {val}",
-        )
-
-    for resi_str, val in rmsd_by_resi.items():
-        _set_bfactor(str(resi_str), val)
+    set_property_bulk(
+        mobile,
+        {mobile_keys[row][:2]: val for row, val in zip(mobile_rows.tolist(), deviations.tolist())},
+    )
 
     cmd.spectrum("b", "blue_white_red", mobile, minimum=0, maximum=max_rmsd)
 
     return rmsd_by_resi
 
 
+def _kabsch_transform(
+    coords: np.ndarray,
+    reference: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Least-squares superposition of `coords` onto `reference` (both (N, 3)).
+
+    Returns (center, rotation, ref_center) so that a point set p is fitted
+    with (p - center) @ rotation + ref_center.
+    """
+    center = coords.mean(axis=0)
+    ref_center = reference.mean(axis=0)
+    u, _, vt = np.linalg.svd((coords - center).T @ (reference - ref_center))
+    if np.linalg.det(u @ vt) < 0:
+        u[:, -1] = -u[:, -1]   # avoid an improper rotation (reflection)
+    return center, u @ vt, ref_center
+
+
+@_forwarded()
+def per_residue_rmsf(
+    obj: str,
+    states: list[int] | None = None,
+    reference: int | str | None = None,
+) -> dict[int, float]:
+    """
+    Calculate per-residue CA fluctuation (RMSF) across the states of `obj`.
+
+    `states` defaults to every state of the object (MD frames, NMR models).
+    `reference` controls superposition of each state before accumulation:
+    None uses coordinates as-is (e.g. after intra_fit), an int fits every
+    state onto that state of `obj`, and an object name fits onto the
+    matching CA atoms of that object.
+
+    States are streamed one at a time into a running mean/variance, so
+    memory stays proportional to the number of atoms, not frames.
+    Returns a dict of {residue_number: rmsf_value} and colors `obj` by RMSF
+    using the B-factor channel (blue=low, red=high).
+    """
+    cmd = get_session().cmd
+
+    if states is None:
+        states = list(range(1, cmd.count_states(obj) + 1))
+    if not states:
+        return {}
+
+    keys, _ = _ca_table(cmd, obj, state=states[0])
+    if not keys:
+        return {}
+
+    # One row per residue; alternate CA positions beyond the first are ignored
+    rows_by_key: dict[tuple[str, str], int] = {}
+    for i, (chain, resi, _) in enumerate(keys):
+        rows_by_key.setdefault((chain, resi), i)
+    rows = np.fromiter(rows_by_key.values(), dtype=np.intp)
+
+    fit_rows = ref_xyz = None
+    if reference is not None:
+        # A reference state need not hold the same CAs as states[0]
+        if isinstance(reference, int):
+            ref_keys, ref_xyz = _ca_table(cmd, obj, state=reference)
+        else:
+            ref_keys, ref_xyz = _ca_table(cmd, reference)
+        fit_rows, ref_rows = _match_residues(keys, ref_keys)
+        ref_xyz = ref_xyz[ref_rows]
+    if ref_xyz is not None and len(ref_xyz) < 3:
+        raise ValueError(f"Too few CA atoms shared with reference {reference!r} to superpose")
+
+    selection = f"({obj}) and name CA"
+    n = 0
+    mean = np.zeros((len(rows), 3))
+    sum_sq = np.zeros(len(rows))
+
+    for state in states:
+        xyz = cmd.get_coords(selection, state=state)
+        if xyz is None or len(xyz) != len(keys):
+            raise ValueError(f"State {state} of {obj!r} does not match the atoms of state {states[0]}")
+        if ref_xyz is not None:
+            center, rotation, ref_center = _kabsch_transform(xyz[fit_rows], ref_xyz)
+            xyz = (xyz - center) @ rotation + ref_center
+
+        # Welford update of the per-atom mean and summed squared deviation
+        frame = xyz[rows]
+        n += 1
+        delta = frame - mean
+        mean += delta / n
+        sum_sq += np.einsum("ij,ij->i", frame - mean, delta)
+
+    rmsf = np.sqrt(sum_sq / n)
+
+    rmsf_by_key = dict(zip(rows_by_key, rmsf.tolist()))
+    rmsf_by_resi = {keys[row][2]: val for row, val in zip(rows.tolist(), rmsf.tolist())}
+
+    # Store RMSF values in B-factor column for coloring
+    set_property_bulk(obj, rmsf_by_key)
+    cmd.spectrum("b", "blue_white_red", obj, minimum=0, maximum=max(rmsf_by_resi.values()))
+
+    return rmsf_by_resi
+
+
 def plot_per_residue_rmsd(rmsd_by_resi: dict[int, float], output_path: str = "rmsd_plot.png") -> str:
     """
     Save a bar chart of per-residue RMSD values using matplotlib.
@@ -278,3 +1587,128 @@ def plot_per_residue_rmsd(rmsd_by_resi: dict[int, float], output_path: str = "rm
     plt.close(fig)
 
     return os.path.abspath(output_path)
+
+
+# ---------------------------------------------------------------------------
+# All-vs-all RMSD matrix
+# ---------------------------------------------------------------------------
+
+RMSD_METHODS = ("align", "super", "cealign")
+
+# (method, mobile fingerprint, target fingerprint) -> (rmsd, alignment length)
+_rmsd_pair_cache: dict[tuple[str, str, str], tuple[float, int]] = {}
+
+
+def _align_pair(cmd, method: str, mobile: str, target: str) -> tuple[float, int]:
+    """Run one alignment without moving anything; returns (rmsd, aligned atoms)."""
+    try:
+        if method == "cealign":
+            result = cmd.cealign(target, mobile, transform=0)
+            return result["RMSD"], result["alignment_length"]
+        result = getattr(cmd, method)(mobile, target, transform=0)
+        return result[0], result[1]
+    except Exception:
+        return float("nan"), 0
+
+
+def _coordinate_fingerprint(cmd, obj: str) -> str:
+    """
+    Hash of what aligning `obj` depends on: its coordinates in every state
+    and each atom's chain, residue and atom identifiers. The object name,
+    B-factors, occupancies and other properties are left out, so a renamed
+    or re-colored copy keeps its cached pairs.
+    """
+    h = hashlib.sha1()
+    coords = cmd.get_coords(f"%{obj}", state=0)
+    if coords is not None:
+        h.update(np.ascontiguousarray(coords, dtype=np.float32).tobytes())
+    ids: list[str] = []
+    cmd.iterate(f"%{obj}", "ids.append(f'{segi}/{chain}/{resi}/{resn}/{name}/{alt}/{elem}')", space={"ids": ids})
+    h.update("\n".join(ids).encode())
+    return h.hexdigest()
+
+
+def _rmsd_worker_init(structures: list[str | None]) -> None:
+    """Pool initializer: load every structure the worker may need into its own session."""
+    cmd = get_session().cmd
+    for i, text in enumerate(structures):
+        if text is not None:
+            cmd.load_raw(text, "cif", f"m{i}")
+
+
+def _rmsd_worker_pair(task: tuple[str, int, int]) -> tuple[float, int]:
+    method, i, j = task
+    return _align_pair(get_session().cmd, method, f"m{i}", f"m{j}")
+
+
+@_forwarded(read_only=True)
+def rmsd_matrix(
+    objects: list[str] | None = None,
+    method: str = "align",
+    processes: int | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute pairwise RMSD between loaded objects without moving them.
+
+    `objects` defaults to every loaded object. Each pair is aligned once
+    (row object as mobile) and mirrored, so the matrix is symmetric with a
+    zero diagonal. Pairs run on a pool of `processes` worker processes
+    (default: one per CPU), each with its own headless PyMOL session;
+    processes=1 runs in the current session instead.
+
+    Results are cached on the objects' coordinate fingerprints, so asking
+    again after an unrelated change only recomputes the affected pairs.
+    Returns (rmsd, lengths): an N x N float32 RMSD matrix (NaN where the
+    alignment failed) and an N x N int32 matrix of aligned atom counts.
+    """
+    if method not in RMSD_METHODS:
+        raise ValueError(f"Unknown method '{method}'. Available: {list(RMSD_METHODS)}")
+
+    cmd = get_session().cmd
+    if objects is None:
+        objects = cmd.get_object_list()
+
+    n = len(objects)
+    rmsd = np.zeros((n, n), dtype=np.float32)
+    lengths = np.zeros((n, n), dtype=np.int32)
+
+    fingerprints = [_coordinate_fingerprint(cmd, obj) for obj in objects]
+
+    results: dict[tuple[int, int], tuple[float, int]] = {}
+    pending: list[tuple[int, int]] = []
+    for i in range(n):
+        for j in range(i + 1, n):
+            key = (method, fingerprints[i], fingerprints[j])
+            if key in _rmsd_pair_cache:
+                results[(i, j)] = _rmsd_pair_cache[key]
+            else:
+                pending.append((i, j))
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(pending))
+
+    if processes <= 1:
+        for i, j in pending:
+            results[(i, j)] = _align_pair(cmd, method, objects[i], objects[j])
+    elif pending:
+        # Only ship the structures that take part in an uncached pair
+        needed = {k for pair in pending for k in pair}
+        shipped = [cmd.get_str("cif", obj) if k in needed else None for k, obj in enumerate(objects)]
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_rmsd_worker_init,
+            initargs=(shipped,),
+        ) as pool:
+            chunksize = max(1, len(pending) // (processes * 4))
+            tasks = [(method, i, j) for i, j in pending]
+            for pair, result in zip(pending, pool.map(_rmsd_worker_pair, tasks, chunksize=chunksize)):
+                results[pair] = result
+
+    for (i, j), (value, length) in results.items():
+        _rmsd_pair_cache[(method, fingerprints[i], fingerprints[j])] = (value, length)
+        rmsd[i, j] = rmsd[j, i] = value
+        lengths[i, j] = lengths[j, i] = length
+
+    return rmsd, lengths
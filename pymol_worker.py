@@ -0,0 +1,334 @@
+"""
+Supervised PyMOL Worker
+
+Runs the pymol_interface functions in a child process so that a command
+that overruns its time budget (or crashes PyMOL) can be killed without
+taking the agent down, and so that one host can drive many independent
+sessions (PyMOLWorkerPool) on all of its cores.
+
+RPC protocol: each request is a (function name, args, kwargs) tuple and
+each reply a ("ok", result) or ("error", exception) tuple, pickled with
+the highest protocol and framed by the multiprocessing Pipe.
+
+Recovery: the worker keeps the session restorable by saving a .pse
+checkpoint now and then and journaling every state-changing call made
+since. After a kill the session is rebuilt from the checkpoint and the
+journal is replayed, which leaves it as it was before the failed call.
+Module state the .pse cannot hold is returned by the checkpoint call and
+handed back when it is loaded.
+The replay is itself time-limited (the sum of the replayed calls'
+budgets), so a call that hangs again cannot hang the recovery.
+"""
+
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+# Take a fresh checkpoint before the next call once this many
+# state-changing calls have been journaled since the last one, or once the
+# oldest of them is this many seconds old.
+JOURNAL_LIMIT = 25
+CHECKPOINT_INTERVAL = 300.0
+
+# Time allowed for saving or loading a checkpoint, and what an unbudgeted
+# call adds to the recovery time limit when it is replayed.
+CHECKPOINT_TIMEOUT = 300.0
+REPLAY_CALL_TIMEOUT = 60.0
+
+
+class CommandTimeout(TimeoutError):
+    """A call overran its time budget; the worker was killed and the session restored."""
+
+    def __init__(self, command: str, budget: float, restored: bool):
+        self.command = command
+        self.budget = budget
+        self.restored = restored
+        outcome = "session restored to its last good state" if restored else "session could not be restored"
+        super().__init__(f"{command!r} exceeded its {budget:g}s time budget and was aborted; {outcome}")
+
+
+class WorkerCrashed(RuntimeError):
+    """The worker process died during a call; the session was restored in a new one."""
+
+
+class _NoReply(Exception):
+    """Internal: the worker did not answer within the call's budget."""
+
+
+def _send(conn, message) -> None:
+    conn.send_bytes(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _recv(conn):
+    return pickle.loads(conn.recv_bytes())
+
+
+def _worker_main(conn) -> None:
+    """Child process entry point: serve pymol_interface calls until told to stop."""
+    import pymol_interface
+
+    while True:
+        try:
+            message = _recv(conn)
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        name, args, kwargs = message
+        try:
+            result = getattr(pymol_interface, name)(*args, **kwargs)
+        except Exception as e:
+            try:
+                _send(conn, ("error", e))
+            except Exception:
+                # Unpicklable exception: ship its text instead
+                _send(conn, ("error", RuntimeError(f"{type(e).__name__}: {e}")))
+            continue
+        try:
+            _send(conn, ("ok", result))
+        except Exception as e:
+            _send(conn, ("error", RuntimeError(f"Cannot return result of {name}: {e}")))
+
+    pymol_interface.close_session()
+
+
+class PyMOLWorker:
+    """A PyMOL session living in a supervised child process."""
+
+    def __init__(self, session_id: str | None = None):
+        self.session_id = session_id
+        self._lock = threading.RLock()   # one call in flight per worker
+        self._process = None
+        self._conn = None
+        self._checkpoint_dir = tempfile.mkdtemp(prefix="pymol_worker_")
+        self._checkpoint: str | None = None
+        self._checkpoint_state: dict | None = None   # what _save_checkpoint returned
+        # (name, args, kwargs, budget) of calls to replay on recovery
+        self._journal: list[tuple[str, tuple, dict, float | None]] = []
+        self._journal_started: float | None = None   # monotonic time of the oldest entry
+        self._sticky: list[tuple[str, tuple, dict, float | None]] = []
+
+    # ------------------------------------------------------------------
+    # Process lifecycle
+    # ------------------------------------------------------------------
+
+    @property
+    def alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self) -> None:
+        """Start the worker process (no-op if it is already running)."""
+        if self.alive:
+            return
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        # Not a daemon: the worker may start process pools of its own (rmsd_matrix)
+        self._process = ctx.Process(target=_worker_main, args=(child_conn,), name="pymol-worker")
+        self._process.start()
+        child_conn.close()
+
+    def _kill(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def stop(self) -> None:
+        """Shut the worker down and discard its checkpoint."""
+        with self._lock:
+            if self.alive:
+                try:
+                    _send(self._conn, None)
+                    self._process.join(timeout=10)
+                except (BrokenPipeError, EOFError, OSError):
+                    pass
+            self._kill()
+            self._discard_checkpoint()
+            shutil.rmtree(self._checkpoint_dir, ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    # Calls
+    # ------------------------------------------------------------------
+
+    def _roundtrip(self, name: str, args: tuple, kwargs: dict, timeout: float | None):
+        """Send one call and wait for its reply; raises _NoReply or EOFError."""
+        _send(self._conn, (name, args, kwargs))
+        if not self._conn.poll(timeout):
+            raise _NoReply(name)
+        status, value = _recv(self._conn)
+        if status == "error":
+            raise value
+        return value
+
+    def call(
+        self,
+        name: str,
+        args: tuple = (),
+        kwargs: dict | None = None,
+        timeout: float | None = None,
+        mutates: bool = True,
+        sticky: bool = False,
+        resets: bool = False,
+        label: str | None = None,
+    ):
+        """
+        Run pymol_interface.<name>(*args, **kwargs) in the worker.
+
+        `timeout` is the call's budget in seconds (None = unlimited). On
+        overrun the worker is killed, the session rebuilt and CommandTimeout
+        raised; `label` names the call in that error. `mutates` marks calls
+        that change the session and must be replayed during recovery;
+        `sticky` calls (configuration) are replayed on every restart.
+        `resets` calls empty the session: afterwards it is rebuilt from
+        the sticky calls alone, as in a fresh worker.
+        """
+        kwargs = kwargs or {}
+        with self._lock:
+            self.start()
+            if self._checkpoint_due():
+                self._save_checkpoint()
+
+            try:
+                result = self._roundtrip(name, args, kwargs, timeout)
+            except _NoReply:
+                restored = self._recover()
+                raise CommandTimeout(label or name, timeout, restored) from None
+            except (EOFError, BrokenPipeError, ConnectionResetError):
+                restored = self._recover()
+                state = "restored" if restored else "could not be restored"
+                raise WorkerCrashed(f"PyMOL worker died during {label or name!r}; session {state}") from None
+
+            if sticky:
+                self._sticky.append((name, args, kwargs, timeout))
+            elif resets:
+                self._discard_checkpoint()
+            elif mutates:
+                if not self._journal:
+                    self._journal_started = time.monotonic()
+                self._journal.append((name, args, kwargs, timeout))
+            return result
+
+    # ------------------------------------------------------------------
+    # Checkpoint / recovery
+    # ------------------------------------------------------------------
+
+    def _checkpoint_due(self) -> bool:
+        return bool(self._journal) and (
+            len(self._journal) >= JOURNAL_LIMIT
+            or time.monotonic() - self._journal_started >= CHECKPOINT_INTERVAL
+        )
+
+    def _save_checkpoint(self) -> None:
+        """Save the session and clear the journal; on failure keep both as they were."""
+        path = os.path.join(self._checkpoint_dir, "checkpoint.pse")
+        partial = os.path.join(self._checkpoint_dir, "checkpoint.partial.pse")
+        try:
+            state = self._roundtrip("_save_checkpoint", (partial,), {}, CHECKPOINT_TIMEOUT)
+        except (_NoReply, EOFError, BrokenPipeError, ConnectionResetError):
+            self._recover()
+            return
+        except Exception:
+            return   # e.g. disk full: keep journaling, retry before the next call
+        os.replace(partial, path)
+        self._checkpoint = path
+        self._checkpoint_state = state
+        self._journal.clear()
+        self._journal_started = None
+
+    def _discard_checkpoint(self) -> None:
+        if self._checkpoint is not None:
+            try:
+                os.remove(self._checkpoint)
+            except OSError:
+                pass
+        self._checkpoint = None
+        self._checkpoint_state = None
+        self._journal.clear()
+        self._journal_started = None
+
+    def _recover(self) -> bool:
+        """
+        Replace the worker and rebuild its session; returns True if fully
+        restored. The rebuild must finish within the sum of the replayed
+        calls' budgets, otherwise the worker is killed again and left to
+        restart empty on the next call.
+        """
+        self._kill()
+        self.start()
+        restored = True
+        calls = list(self._sticky)
+        if self._checkpoint is not None:
+            calls.append(("_load_checkpoint", (self._checkpoint, self._checkpoint_state), {}, CHECKPOINT_TIMEOUT))
+        calls.extend(self._journal)
+        deadline = time.monotonic() + sum(
+            budget if budget is not None else REPLAY_CALL_TIMEOUT for *_, budget in calls
+        )
+        for name, args, kwargs, _ in calls:
+            try:
+                self._roundtrip(name, args, kwargs, max(deadline - time.monotonic(), 0.0))
+            except (_NoReply, EOFError, BrokenPipeError, ConnectionResetError):
+                self._kill()
+                return False
+            except Exception:
+                restored = False
+        return restored
+
+
+class PyMOLWorkerPool:
+    """
+    Independent PyMOL sessions keyed by session id, one worker process each.
+
+    Workers are started on first use of a session id; `prestart` workers
+    are launched up front so the first sessions skip the process start-up.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_sessions: int, prestart: int = 0):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: dict[str, PyMOLWorker] = {}
+        self._spare: list[PyMOLWorker] = []
+        for _ in range(min(prestart, max_sessions)):
+            worker = PyMOLWorker()
+            worker.start()
+            self._spare.append(worker)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def session(self, session_id: str) -> PyMOLWorker:
+        """Return the worker holding `session_id`, starting one if needed."""
+        with self._lock:
+            worker = self._sessions.get(session_id)
+            if worker is None:
+                if len(self._sessions) >= self.max_sessions:
+                    raise RuntimeError(f"PyMOL worker pool is full ({self.max_sessions} sessions)")
+                worker = self._spare.pop() if self._spare else PyMOLWorker()
+                worker.session_id = session_id
+                worker.start()
+                self._sessions[session_id] = worker
+            return worker
+
+    def release(self, session_id: str) -> None:
+        """Stop the worker holding `session_id`; its session is discarded."""
+        with self._lock:
+            worker = self._sessions.pop(session_id, None)
+        if worker is not None:
+            worker.stop()
+
+    def close(self) -> None:
+        """Stop every worker in the pool."""
+        with self._lock:
+            workers = list(self._sessions.values()) + self._spare
+            self._sessions.clear()
+            self._spare.clear()
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,103 @@
+"""
+On-disk LLM Response Cache
+
+Stores model replies keyed by what determines them in practice: the
+normalized user message, the agent mode, a fingerprint of the PyMOL
+session state and the model name. A class full of students asking "show
+1ubq as cartoon colored by chain" against the same starting session then
+costs one API call instead of sixty.
+
+Entries are one JSON file each, written atomically, so several agent
+processes can share a directory. Entries expire after `ttl_s`; when the
+directory grows past `max_bytes` the least recently used ones (by file
+mtime, refreshed on every hit) are deleted.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from disk_store import evict_lru, remove_quietly, touch, write_atomic
+
+MAX_BYTES = 64 * 1024 * 1024
+TTL_S = 7 * 24 * 3600
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Case-fold, collapse whitespace and drop trailing punctuation."""
+    return _SPACE_RE.sub(" ", text.casefold()).strip().rstrip(".!?").strip()
+
+
+def session_fingerprint(snapshot: dict) -> str:
+    """
+    Hash of a get_session_snapshot() result. It covers the same objects,
+    counts and selections as get_session_state(), but is independent of
+    the recency ordering that serializer applies.
+    """
+    return hashlib.sha256(json.dumps(snapshot, sort_keys=True).encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU + TTL cache of model replies in `directory`."""
+
+    def __init__(self, directory: str, max_bytes: int = MAX_BYTES, ttl_s: float = TTL_S):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(prompt: str, mode: str, fingerprint: str, model: str) -> str:
+        material = json.dumps([normalize_prompt(prompt), mode, fingerprint, model])
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> str | None:
+        """The cached reply for `key`, or None if absent or expired."""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and time.time() - entry["created"] > self.ttl_s:
+            remove_quietly(path)
+            entry = None
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        touch(path)
+        return entry["reply"]
+
+    def put(self, key: str, reply: str, **info) -> None:
+        """Store `reply`; extra keyword arguments are saved alongside for inspection."""
+        entry = {"reply": reply, "created": time.time(), **info}
+        write_atomic(self._path(key), json.dumps(entry).encode())
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete expired entries, then the least recently used until under max_bytes."""
+        # mtime is the last use; an unused entry older than the TTL has expired too
+        evict_lru(self.directory, ".json", self.max_bytes, max_age_s=self.ttl_s)
+
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                remove_quietly(os.path.join(self.directory, name))
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"response cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
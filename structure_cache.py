@@ -0,0 +1,359 @@
+"""
+Local Structure Cache
+
+Content-addressed on-disk store for structures fetched by PDB ID, so a
+new session does not go back to RCSB for structures it has seen before.
+
+Layout under the cache directory:
+
+    index.json                       {"1ubq.cif": {"sha256", "size", "last_used", "source"}, ...}
+    objects/<h[:2]>/<h>.<format>     file contents, named by their SHA-256
+
+Every read re-hashes the file and discards it on a mismatch, so a
+truncated or corrupted download is fetched again instead of loaded. When
+the stored files exceed `max_bytes` the least recently used entries are
+evicted. Several processes (pooled PyMOL workers) can share a directory:
+index updates are serialized with a lock file and files are written
+atomically.
+
+Sources, in order: the cache, an optional mirror directory (plain,
+gzipped or wwPDB "divided" layout), then RCSB over HTTPS. In offline
+mode (the default when a mirror is configured) the network is never
+used. prefetch() fills the cache from background threads ahead of use,
+e.g. for the PDB IDs in a user's message while the model is answering.
+Configuration comes from the environment, so worker processes inherit it:
+
+    PYMOL_AGENT_STRUCTURE_CACHE    cache directory (default ~/.cache/pymol_agent/structures)
+    PYMOL_AGENT_STRUCTURE_MIRROR   mirror directory
+    PYMOL_AGENT_OFFLINE            1 / 0 to force offline mode on or off
+    PYMOL_AGENT_STRUCTURE_CACHE_MB size limit
+"""
+
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from disk_store import remove_quietly, sha256_file, write_atomic
+
+try:
+    import fcntl
+except ImportError:   # not available on Windows; index updates are then per-process only
+    fcntl = None
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pymol_agent", "structures")
+DEFAULT_MAX_MB = 2048
+DOWNLOAD_URL = "https://files.rcsb.org/download/{id}.{format}.gz"
+DOWNLOAD_TIMEOUT_S = 60
+FORMATS = ("cif", "pdb")
+
+PDB_ID_RE = re.compile(r"^[0-9][A-Za-z0-9]{3}$")
+
+
+class StructureNotFound(LookupError):
+    """The structure is not cached, not in the mirror and could not be downloaded."""
+
+
+def is_pdb_id(text: str) -> bool:
+    return bool(PDB_ID_RE.match(text))
+
+
+class StructureCache:
+    """Structures by (PDB ID, format); see the module docstring."""
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_DIR,
+        max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024,
+        mirror: str | None = None,
+        offline: bool | None = None,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.mirror = mirror
+        self.offline = bool(mirror) if offline is None else offline
+        self._index_path = os.path.join(directory, "index.json")
+        self._lock_path = os.path.join(directory, ".lock")
+        self._thread_lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+
+    # ------------------------------------------------------------------
+    # Index
+    # ------------------------------------------------------------------
+
+    @contextlib.contextmanager
+    def _locked_index(self, write: bool = True):
+        """Yield the index dict under the cache lock; saved on exit if `write`."""
+        with self._thread_lock, open(self._lock_path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                yield index
+                if write:
+                    write_atomic(self._index_path, json.dumps(index).encode())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self) -> dict:
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _object_path(self, digest: str, fmt: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], f"{digest}.{fmt}")
+
+    @staticmethod
+    def _key(pdb_id: str, fmt: str) -> str:
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported format '{fmt}'. Available: {list(FORMATS)}")
+        return f"{pdb_id.lower()}.{fmt}"
+
+    # ------------------------------------------------------------------
+    # Lookup / store
+    # ------------------------------------------------------------------
+
+    def get(self, pdb_id: str, fmt: str = "cif") -> str | None:
+        """Path of the verified cached file, or None (nothing is fetched)."""
+        key = self._key(pdb_id, fmt)
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = self._object_path(entry["sha256"], fmt)
+            if not os.path.exists(path) or sha256_file(path) != entry["sha256"]:
+                del index[key]
+                self._remove_unreferenced(index, path)
+                return None
+            entry["last_used"] = time.time()
+            return path
+
+    def put(self, pdb_id: str, fmt: str, data: bytes, source: str) -> str:
+        """Store `data` as (pdb_id, fmt) and return its path."""
+        key = self._key(pdb_id, fmt)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest, fmt)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, data)
+        with self._locked_index() as index:
+            index[key] = {"sha256": digest, "size": len(data), "last_used": time.time(), "source": source}
+            self._evict(index, keep=key)
+        return path
+
+    def path(self, pdb_id: str, fmt: str = "cif") -> str:
+        """
+        Local path of the structure, taking it from the mirror or RCSB on a
+        cache miss. Raises StructureNotFound if no source has it.
+        """
+        path = self.get(pdb_id, fmt)
+        if path is not None:
+            return path
+        data, source = self._from_mirror(pdb_id, fmt)
+        if data is None:
+            if self.offline:
+                where = f"mirror {self.mirror}" if self.mirror else "the local cache"
+                raise StructureNotFound(f"{pdb_id} ({fmt}) is not in {where} and offline mode is on")
+            data, source = self._download(pdb_id, fmt)
+        return self.put(pdb_id, fmt, data, source)
+
+    # ------------------------------------------------------------------
+    # Sources
+    # ------------------------------------------------------------------
+
+    def _mirror_candidates(self, pdb_id: str, fmt: str) -> list[str]:
+        pid = pdb_id.lower()
+        mid = pid[1:3]
+        names = [f"{pid}.{fmt}", f"{pid.upper()}.{fmt}"]
+        if fmt == "pdb":
+            names += [f"pdb{pid}.ent", f"{pid}.ent"]
+        names += [n + ".gz" for n in names]
+        dirs = [self.mirror, os.path.join(self.mirror, mid)]
+        if fmt == "cif":
+            dirs.append(os.path.join(self.mirror, "mmCIF", mid))
+        else:
+            dirs.append(os.path.join(self.mirror, "pdb", mid))
+        return [os.path.join(d, n) for d in dirs for n in names]
+
+    def _from_mirror(self, pdb_id: str, fmt: str) -> tuple[bytes | None, str | None]:
+        if not self.mirror:
+            return None, None
+        for candidate in self._mirror_candidates(pdb_id, fmt):
+            if os.path.exists(candidate):
+                opener = gzip.open if candidate.endswith(".gz") else open
+                with opener(candidate, "rb") as f:
+                    return f.read(), candidate
+        return None, None
+
+    def _download(self, pdb_id: str, fmt: str) -> tuple[bytes, str]:
+        url = DOWNLOAD_URL.format(id=pdb_id.upper(), format=fmt)
+        try:
+            with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT_S) as response:
+                data = response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise StructureNotFound(f"{pdb_id} ({fmt}) not found at RCSB") from None
+            raise
+        return gzip.decompress(data), url
+
+    # ------------------------------------------------------------------
+    # Eviction
+    # ------------------------------------------------------------------
+
+    def _remove_unreferenced(self, index: dict, path: str) -> None:
+        digest = os.path.basename(path).split(".")[0]
+        if not any(entry["sha256"] == digest for entry in index.values()):
+            remove_quietly(path)
+
+    def _evict(self, index: dict, keep: str | None = None) -> None:
+        sizes = {entry["sha256"]: entry["size"] for entry in index.values()}
+        total = sum(sizes.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del index[key]
+            fmt = key.rsplit(".", 1)[1]
+            self._remove_unreferenced(index, self._object_path(entry["sha256"], fmt))
+            if not any(e["sha256"] == entry["sha256"] for e in index.values()):
+                total -= entry["size"]
+
+    def evict(self) -> None:
+        """Trim the cache to max_bytes now."""
+        with self._locked_index() as index:
+            self._evict(index)
+
+    def stats(self) -> dict:
+        index = self._read_index()
+        return {
+            "entries": len(index),
+            "bytes": sum({e["sha256"]: e["size"] for e in index.values()}.values()),
+            "max_bytes": self.max_bytes,
+            "mirror": self.mirror,
+            "offline": self.offline,
+        }
+
+
+# ---------------------------------------------------------------------------
+# Reference detection and prefetch
+# ---------------------------------------------------------------------------
+
+PREFETCH_THREADS = 8
+
+# A PDB ID standing on its own: not part of a longer word, path or file name
+_ID_TOKEN_RE = re.compile(r"(?<![\w./\\-])([0-9][A-Za-z0-9]{3})(?![\w/\\-]|\.\w)")
+
+# Valid IDs that read as a number with a unit or an ordinal ("10th",
+# "300k", "5min", "2nd"); these count only after a fetch verb or "PDB" in
+# the same clause, as in "fetch 101m" or "PDB entries 1abc and 101m".
+_NUMBER_WORD_RE = re.compile(
+    r"[0-9]+(?:st|nd|rd|th|k|m|g|s|h|d|x|ms|us|ns|ps|fs|nm|am|pm|kb|mb|gb|px|hr|hrs|min|sec|mins|secs|kda)",
+    re.IGNORECASE,
+)
+_ID_CONTEXT_RE = re.compile(r"\b(?:pdb|fetch|load|download)\b[^.;:!?\n]{0,40}$", re.IGNORECASE)
+_PATH_TOKEN_RE = re.compile(
+    r"[\w./~\\-]+\.(?:pdb|ent|cif|mmcif|bcif|pqr|mol2|sdf|mae|xyz|pse)(?:\.gz)?\b", re.IGNORECASE,
+)
+
+_prefetch_lock = threading.Lock()
+_prefetch_executor: ThreadPoolExecutor | None = None
+_inflight: dict[tuple, Future] = {}
+
+
+def structure_refs(text: str) -> tuple[list[str], list[str]]:
+    """
+    PDB IDs and existing structure file paths mentioned in `text`, in order
+    of appearance. IDs must contain a letter, which keeps years and other
+    four-digit numbers out; ones that read as a number with a unit or an
+    ordinal must follow a fetch verb or "PDB" (see _NUMBER_WORD_RE).
+    """
+    ids = []
+    for match in _ID_TOKEN_RE.finditer(text):
+        token = match.group(1).lower()
+        if not any(c.isalpha() for c in token) or token in ids:
+            continue
+        if _NUMBER_WORD_RE.fullmatch(token) and not _ID_CONTEXT_RE.search(text, 0, match.start()):
+            continue
+        ids.append(token)
+    paths = []
+    for token in _PATH_TOKEN_RE.findall(text):
+        path = os.path.expanduser(token)
+        if path not in paths and os.path.isfile(path):
+            paths.append(path)
+    return ids, paths
+
+
+def _warm_file(path: str) -> None:
+    # Reading the file once pulls it into the OS page cache for the real load
+    with open(path, "rb") as f:
+        while f.read(1 << 20):
+            pass
+
+
+def prefetch(pdb_ids=(), paths=(), fmt: str = "cif") -> list[Future]:
+    """
+    Start bringing `pdb_ids` into the structure cache (and `paths` into the
+    OS page cache) on background threads. Returns one future per item; a
+    request already in flight is shared. Failures stay in the futures.
+    """
+    global _prefetch_executor
+    futures, submitted = [], []
+    with _prefetch_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(PREFETCH_THREADS, thread_name_prefix="prefetch")
+        tasks = [(("id", i.lower(), fmt), get_structure_cache().path, (i, fmt)) for i in pdb_ids]
+        tasks += [(("path", p), _warm_file, (p,)) for p in paths]
+        for key, func, args in tasks:
+            future = _inflight.get(key)
+            if future is None:
+                future = _inflight[key] = _prefetch_executor.submit(func, *args)
+                submitted.append((key, future))
+            futures.append(future)
+    # Outside the lock: a future that is already done runs its callback
+    # right here, and _forget takes the lock
+    for key, future in submitted:
+        future.add_done_callback(lambda future, key=key: _forget(key, future))
+    return futures
+
+
+def _forget(key: tuple, future: Future) -> None:
+    with _prefetch_lock:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+
+def prefetch_refs(text: str) -> list[Future]:
+    """prefetch() everything structure_refs() finds in `text`."""
+    ids, paths = structure_refs(text)
+    return prefetch(ids, paths) if ids or paths else []
+
+
+# ---------------------------------------------------------------------------
+# Process-wide cache configured from the environment
+# ---------------------------------------------------------------------------
+
+_cache: StructureCache | None = None
+
+
+def get_structure_cache() -> StructureCache:
+    global _cache
+    if _cache is None:
+        offline = os.environ.get("PYMOL_AGENT_OFFLINE")
+        _cache = StructureCache(
+            os.environ.get("PYMOL_AGENT_STRUCTURE_CACHE") or DEFAULT_DIR,
+            max_bytes=int(os.environ.get("PYMOL_AGENT_STRUCTURE_CACHE_MB") or DEFAULT_MAX_MB) * 1024 * 1024,
+            mirror=os.environ.get("PYMOL_AGENT_STRUCTURE_MIRROR") or None,
+            offline=None if offline is None else offline.lower() in ("1", "true", "yes"),
+        )
+    return _cache
@@ -0,0 +1,174 @@
+"""
+Streaming Structure Filters
+
+Reads a PDB or mmCIF file line by line and keeps only the atom records of
+the requested chains and models, so a few chains of a ribosome or capsid
+can be loaded without parsing the rest. Everything that is not an atom
+record (header, secondary structure, other mmCIF categories) is passed
+through, and CONECT records are kept only between kept atoms. The filter
+counts what it dropped, which load_structure records as the object's
+unloaded remainder.
+
+Chains are matched on the author chain ID (PDB column 22, mmCIF
+auth_asym_id, falling back to label_asym_id), as PyMOL's `chain`
+selector does. Models are numbered from 1; a file without MODEL records
+is model 1. Gzipped files are read transparently.
+"""
+
+import gzip
+import re
+
+CIF_EXTENSIONS = (".cif", ".mmcif")
+PDB_EXTENSIONS = (".pdb", ".ent")
+
+# mmCIF values: quoted strings (a quote only closes before whitespace) or bare words
+_CIF_TOKEN_RE = re.compile(r"""'(?:[^']|'(?=\S))*'|"(?:[^"]|"(?=\S))*"|\S+""")
+
+
+def structure_format(path: str) -> str | None:
+    """"cif" or "pdb" for a path the filters can read, else None."""
+    name = path.lower()
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith(CIF_EXTENSIONS):
+        return "cif"
+    if name.endswith(PDB_EXTENSIONS):
+        return "pdb"
+    return None
+
+
+def parse_chains(chains) -> list[str] | None:
+    """Chain IDs from "A", "A+B", "A,B", "A B" or a list; None means all chains."""
+    if chains is None:
+        return None
+    if isinstance(chains, str):
+        chains = re.split(r"[\s,+]+", chains.strip())
+    return [c for c in chains if c]
+
+
+def parse_states(states) -> list[int] | None:
+    """Model numbers from 3, "1-5", "1,4,7-9" or a list; None means all models."""
+    if states is None:
+        return None
+    if isinstance(states, int):
+        return [states]
+    if isinstance(states, str):
+        numbers = []
+        for part in filter(None, re.split(r"[\s,+]+", states.strip())):
+            first, _, last = part.partition("-")
+            numbers.extend(range(int(first), int(last or first) + 1))
+        return numbers
+    return [int(s) for s in states]
+
+
+def _filter_pdb(lines, chains: set | None, states: set | None, dropped: dict):
+    model = 1
+    keep_model = states is None or model in states
+    kept_serials: set[str] = set()
+    for line in lines:
+        record = line[:6]
+        if record == "MODEL ":
+            model = int(line[6:].split()[0])
+            keep_model = states is None or model in states
+            if keep_model:
+                yield line
+            continue
+        if record == "ENDMDL":
+            if keep_model:
+                yield line
+            continue
+        is_atom = record in ("ATOM  ", "HETATM")
+        if is_atom or record.startswith(("ANISOU", "TER")):
+            if not keep_model:
+                if is_atom:
+                    dropped["atoms"] += 1
+                    dropped["states"].add(model)
+                continue
+            chain = line[21:22].strip()
+            if chains is not None and chain not in chains:
+                if is_atom:
+                    dropped["atoms"] += 1
+                    dropped["chains"][chain] = dropped["chains"].get(chain, 0) + 1
+                continue
+            if is_atom:
+                kept_serials.add(line[6:11].strip())
+            yield line
+        elif record == "CONECT":
+            serials = [line[i:i + 5].strip() for i in range(6, 31, 5)]
+            if all(s in kept_serials for s in serials if s):
+                yield line
+        else:
+            yield line
+
+
+def _filter_cif(lines, chains: set | None, states: set | None, dropped: dict):
+    headers: list[str] = []
+    in_headers = False
+    columns = None      # _atom_site column names while inside that loop
+    pending: list[str] = []   # start of a row that continues on the next line
+    for line in lines:
+        stripped = line.lstrip()
+        if in_headers and stripped.startswith("_"):
+            headers.append(stripped.split()[0])
+            yield line
+            continue
+        if in_headers:
+            in_headers = False
+            if headers and headers[0].startswith("_atom_site."):
+                columns = [h[len("_atom_site."):] for h in headers]
+                chain_col = columns.index("auth_asym_id") if "auth_asym_id" in columns \
+                    else columns.index("label_asym_id")
+                model_col = columns.index("pdbx_PDB_model_num") if "pdbx_PDB_model_num" in columns else None
+        if columns is not None:
+            if stripped and not stripped.startswith(("_", "#", "loop_", "data_")):
+                if pending or "'" in line or '"' in line:
+                    pending.append(line)
+                    row = "".join(pending)
+                    tokens = _CIF_TOKEN_RE.findall(row)
+                else:
+                    row = line
+                    tokens = line.split()
+                if len(tokens) < len(columns):
+                    pending = [row]
+                    continue
+                pending = []
+                model = int(tokens[model_col]) if model_col is not None else 1
+                chain = tokens[chain_col].strip("'\"")
+                if chain in (".", "?"):   # unknown / not applicable: a blank chain to PyMOL
+                    chain = ""
+                if states is not None and model not in states:
+                    dropped["atoms"] += 1
+                    dropped["states"].add(model)
+                elif chains is not None and chain not in chains:
+                    dropped["atoms"] += 1
+                    dropped["chains"][chain] = dropped["chains"].get(chain, 0) + 1
+                else:
+                    yield row
+                continue
+            columns = None
+        if stripped.startswith("loop_"):
+            headers, in_headers = [], True
+        yield line
+
+
+def filter_structure(path: str, chains=None, states=None, fmt: str | None = None) -> tuple[str, dict]:
+    """
+    Text of `path` keeping only atoms in `chains` and models in `states`
+    (see parse_chains / parse_states; None keeps everything). Returns
+    (text, dropped) with dropped = {"atoms": n, "chains": {chain: atoms
+    dropped from kept models}, "states": [models dropped]}.
+    """
+    fmt = fmt or structure_format(path)
+    if fmt not in ("cif", "pdb"):
+        raise ValueError(f"Cannot filter '{path}': only PDB and mmCIF files can be loaded in part")
+    chains = parse_chains(chains)
+    states = parse_states(states)
+    dropped = {"atoms": 0, "chains": {}, "states": set()}
+    opener = gzip.open if path.lower().endswith(".gz") else open
+    with opener(path, "rt") as f:
+        filtered = (_filter_cif if fmt == "cif" else _filter_pdb)(
+            f, None if chains is None else set(chains), None if states is None else set(states), dropped,
+        )
+        text = "".join(filtered)
+    dropped["states"] = sorted(dropped["states"])
+    return text, dropped
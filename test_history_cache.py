@@ -0,0 +1,41 @@
+"""
+Check that conversation history is read back from the prompt cache across
+turns, using the stub client's cache simulation (no API key or network).
+
+    python -m pytest -q test_history_cache.py     # or: python test_history_cache.py
+"""
+
+from agent import AgentSession, ConversationHistory
+from llm_backend import make_backend
+
+SYSTEM = "You are a PyMOL assistant.\n" * 200
+SYSTEM_TOKENS = len(SYSTEM) // 4
+
+
+def test_history_prefix_is_read_from_cache():
+    agent = AgentSession(
+        make_backend("stub", "stub-model"), SYSTEM,
+        max_steps=1, fast_path=False, prefetch=False, echo=False,
+    )
+    # Small budget so the run includes compaction passes
+    agent.history = ConversationHistory(max_chars=8000, keep_turns=2, output_chars=100, compact_to=4000)
+
+    passes = []
+    for n in range(16):
+        omitted = agent.history.omitted_turns
+        agent.turn(f"Request {n}: " + "describe the structure in detail " * 12)
+        passes.append(agent.history.omitted_turns != omitted)
+
+    assert any(passes), "the run never compacted; lower max_chars"
+    for n, usage in enumerate(agent.usage_log):
+        # Turn 0 has no earlier reply to cache, turn 1 writes the first one;
+        # right after a compaction pass the history prefix is rebuilt once
+        if n < 2 or passes[n] or passes[n - 1]:
+            continue
+        assert usage["cache_read"] > SYSTEM_TOKENS, f"turn {n} did not read the history from the cache: {usage}"
+        assert usage["cache_write"] < 1000, f"turn {n} rewrote more than its own new messages: {usage}"
+
+
+if __name__ == "__main__":
+    test_history_prefix_is_read_from_cache()
+    print("ok")
@@ -0,0 +1,54 @@
+"""
+Checks for structure reference detection and prefetch (no network: only
+local files are prefetched).
+
+    python -m pytest -q test_structure_cache.py     # or: python test_structure_cache.py
+"""
+
+import tempfile
+import threading
+from concurrent.futures import Future
+
+import structure_cache
+
+
+class _InlineExecutor:
+    """Runs each task before returning its future, so callbacks fire at once."""
+
+    def submit(self, func, *args):
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+def test_prefetch_of_finished_future_does_not_deadlock():
+    with tempfile.NamedTemporaryFile(suffix=".pdb") as f:
+        f.write(b"END\n")
+        f.flush()
+        saved = structure_cache._prefetch_executor
+        structure_cache._prefetch_executor = _InlineExecutor()
+        try:
+            done = []
+            thread = threading.Thread(target=lambda: done.append(structure_cache.prefetch(paths=[f.name])), daemon=True)
+            thread.start()
+            thread.join(timeout=5)
+        finally:
+            structure_cache._prefetch_executor = saved
+    assert done, "prefetch() deadlocked on a future that was already done"
+    assert done[0][0].done()
+    assert not structure_cache._inflight, "finished prefetches must leave the in-flight table"
+
+
+def test_number_words_are_not_pdb_ids():
+    text = "For the 10th frame, run 300k steps in 5min and show the 2nd chain of 4hhb"
+    assert structure_cache.structure_refs(text)[0] == ["4hhb"]
+    # The same shapes are real IDs when named as structures
+    assert structure_cache.structure_refs("fetch 101m, 1abc")[0] == ["101m", "1abc"]
+    assert structure_cache.structure_refs("compare PDB entries 1ubq and 200d")[0] == ["1ubq", "200d"]
+    assert structure_cache.structure_refs("load it. Then wait 5min")[0] == []
+
+
+if __name__ == "__main__":
+    test_prefetch_of_finished_future_does_not_deadlock()
+    test_number_words_are_not_pdb_ids()
+    print("ok")